@@ -1,13 +1,28 @@
 from enum import StrEnum
+import asyncio
+import json
+import os
+import shutil
+import threading
 import uuid
-from fastapi import BackgroundTasks, FastAPI, File, HTTPException, UploadFile, Form
-import requests
+from fastapi import FastAPI, File, HTTPException, UploadFile, Form
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from auth import APIKeyMiddleware
 from pydantic import BaseModel
-from typing import Optional, Dict
+from typing import Optional
+from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
-from pdf_to_markdown import ConverterByGPT, ConverterByDocumentIntelligence
+from cache import result_cache
+from config import (
+    ASYNC_ENGINE, CONVERSION_MODE, JOB_POLL_INTERVAL, JOB_WORKERS, MAX_SYNC_JOBS, SYNC_JOBS_RETRY_AFTER, UPLOAD_BLOCK_SIZE, UPLOAD_SPOOL_DIR
+)
+from deployments import di_pool, document_pool, ocr_pool
+from job_queue import JobQueue, JobState, start_workers, stop_workers
+from metrics import metrics
+from pdf_to_markdown import ConverterByCascade, ConverterByGPT, ConverterByDocumentIntelligence
+from webhooks import WebhookDispatcher, WebhookOutbox
 
 
 class Status(StrEnum):
@@ -19,52 +34,204 @@ class ResponseData(BaseModel):
     status: Status
     output_gpt: Optional[str] = None
     output_document: Optional[str] = None
+    output_cascade: Optional[str] = None  # Cascade mode: one section per page, from Document Intelligence or vision GPT
     error: Optional[str] = None
+    report_gpt: Optional[dict] = None
+    report_cascade: Optional[dict] = None
+    timings_gpt: Optional[dict] = None  # {stage: {"seconds": ..., "count": ...}}
+    timings_document: Optional[dict] = None
 
-store: Dict[str, ResponseData] = {}
+class Progress:
+    """Turns converter callbacks into page and chunk events with progress counters; emit(event) delivers them"""
+    def __init__(self, emit):
+        self.emit = emit
+        self.completed = {"gpt": 0, "document": 0}
+        self.lock = threading.Lock()
 
-app = FastAPI()
+    def event(self, source: str, index: int, first_page: int, last_page: int, total: int, content: str, failed: bool = False):
+        with self.lock:
+            self.completed[source] += 1
+            completed = self.completed[source]
+        self.emit({
+            "source": source,
+            "index": index,
+            "first_page": first_page + 1,
+            "last_page": last_page + 1,
+            "total": total,
+            "completed": completed,
+            "failed": failed,
+            "markdown": content
+        })
+
+    def on_page(self, page_num: int, content: str, total_pages: int, failed: bool = False):
+        self.event("gpt", page_num, page_num, page_num, total_pages, content, failed)
+
+    def on_chunk(self, chunk_index: int, chunk_pages, content: str, total_chunks: int):
+        self.event("document", chunk_index, chunk_pages[0], chunk_pages[-1], total_chunks, content)
+
+def sse(event: str, data: dict):
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+job_queue = JobQueue()
+webhook_outbox = WebhookOutbox()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the shared SDK clients before the first request instead of during it
+    for pool in (ocr_pool, di_pool, document_pool):
+        await asyncio.to_thread(pool.warm_up)
+
+    # Snapshots left by processes of an earlier run would be counted twice
+    metrics.clear_snapshots()
+
+    # Background jobs are consumed by worker processes, not by the web process
+    workers, stop_event = start_workers(process_job, JOB_WORKERS)
+
+    # Results of finished jobs are posted to their hook_url from here, whichever process converted them
+    dispatcher_stop = threading.Event()
+    dispatcher = asyncio.create_task(WebhookDispatcher(webhook_outbox, job_queue).run(dispatcher_stop))
+    yield
+    stop_workers(workers, stop_event)
+    dispatcher_stop.set()
+    await dispatcher
+    for pool in (ocr_pool, di_pool, document_pool):
+        await pool.close_async_clients()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(APIKeyMiddleware)
 
-def run_kickoff(pdf_content: bytes, job_id: str, hook_url: str):
-    try:
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            # Submit both converter tasks to the executor
-            future_gpt = executor.submit(ConverterByGPT(job_id).convert_pdf, pdf_content=pdf_content)
-            future_document = executor.submit(ConverterByDocumentIntelligence().convert_pdf, pdf_content=pdf_content)
+# Synchronous conversions run on their own bounded pool so they never block the event loop
+sync_executor = ThreadPoolExecutor(max_workers=MAX_SYNC_JOBS)
+sync_slots = threading.BoundedSemaphore(MAX_SYNC_JOBS)
+
+# Conversions started by /kickoff_stream keep running after a client disconnects; hold on to them until they finish
+background_tasks = set()
+
+def create_converters(job_id: str, progress: Progress = None, checkpoint: dict = None):
+    """Both converters of a job, reporting to progress and reusing checkpointed pages and chunks"""
+    checkpoint = checkpoint or {}
+    # Synchronous jobs have no id, so give each its own temp directory and its own turn at the rate limiters
+    job_id = job_id or str(uuid.uuid4())
+    converter_gpt = ConverterByGPT(job_id, on_page=progress.on_page if progress else None, checkpoint=checkpoint.get("gpt"))
+    converter_document = ConverterByDocumentIntelligence(
+        job_id, on_chunk=progress.on_chunk if progress else None, checkpoint=checkpoint.get("document")
+    )
+    return converter_gpt, converter_document
+
+def finished_response(converter_gpt, converter_document, output_gpt: str, output_document: str):
+    return ResponseData(
+        status=Status.FINISHED, output_gpt=output_gpt, output_document=output_document, report_gpt=converter_gpt.report,
+        timings_gpt=converter_gpt.timings.summary(), timings_document=converter_document.timings.summary()
+    )
+
+def cascade_response(converter, output: str):
+    return ResponseData(
+        status=Status.FINISHED, output_cascade=output, report_gpt=converter.converter_gpt.report, report_cascade=converter.report,
+        timings_gpt=converter.converter_gpt.timings.summary(), timings_document=converter.converter_document.timings.summary()
+    )
 
-            # Wait for both futures to complete and get their results
-            output_gpt = future_gpt.result()
-            output_document = future_document.result()
+def deliver_result(job_id: str, hook_url: str, response: ResponseData):
+    """Put the result in the webhook outbox; the dispatcher posts it to hook_url and retries until it is accepted"""
+    if hook_url != "":
+        try:
+            webhook_outbox.enqueue(job_id, hook_url, response.model_dump(mode="json", exclude_none=True))
+        except Exception as e:
+            print(f"Failed to queue result of job {job_id} for {hook_url}: {str(e)}")
 
+def spool_upload(file: UploadFile):
+    """Copy an upload block by block to its own spool file and return the path; converters read it from disk"""
+    Path(UPLOAD_SPOOL_DIR).mkdir(parents=True, exist_ok=True)
+    pdf_path = os.path.join(UPLOAD_SPOOL_DIR, f"{uuid.uuid4()}.pdf")
+    with open(pdf_path, "wb") as f:
+        shutil.copyfileobj(file.file, f, UPLOAD_BLOCK_SIZE)
+    return pdf_path
 
-        if job_id == "":
-            return ResponseData(status=Status.FINISHED, output_gpt=output_gpt, output_document=output_document)
-        elif hook_url == "":
-            # Store the results in the shared store
-            store[job_id] = ResponseData(status=Status.FINISHED, output_gpt=output_gpt, output_document=output_document)
+def remove_upload(pdf_path: str):
+    try:
+        os.remove(pdf_path)
+    except OSError:
+        pass
+
+def run_kickoff(pdf_path: str, job_id: str, hook_url: str, progress: Progress = None, checkpoint: dict = None):
+    """Run both converters on the spooled PDF, reusing checkpointed pages and chunks, and deliver the result to hook_url when one is given"""
+    try:
+        if CONVERSION_MODE == "cascade":
+            # Document Intelligence first, then vision GPT on the pages it escalates
+            converter = ConverterByCascade(*create_converters(job_id, progress, checkpoint))
+            response = cascade_response(converter, converter.convert_pdf(pdf_path))
         else:
-            # call hook_url with parsing result
-            requests.post(hook_url, json={
-                "status": Status.FINISHED,
-                "output_gpt": output_gpt,
-                "output_document": output_document
-            })
-
-            # Free the variables
-            del output_gpt
-            del output_document
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                # Submit both converter tasks to the executor
+                converter_gpt, converter_document = create_converters(job_id, progress, checkpoint)
+                future_gpt = executor.submit(converter_gpt.convert_pdf, pdf_path=pdf_path)
+                future_document = executor.submit(converter_document.convert_pdf, pdf_path=pdf_path)
+
+                # Wait for both futures to complete and get their results
+                output_gpt = future_gpt.result()
+                output_document = future_document.result()
+
+            response = finished_response(converter_gpt, converter_document, output_gpt, output_document)
     except Exception as e:
-        if job_id == "":
-            return ResponseData(status=Status.FAILED, error=str(e))
-        elif hook_url == "":
-            store[job_id] = ResponseData(status=Status.FAILED, error=str(e))
+        response = ResponseData(status=Status.FAILED, error=str(e))
+
+    deliver_result(job_id, hook_url, response)
+    return response
+
+async def run_kickoff_async(pdf_path: str, job_id: str, hook_url: str, progress: Progress = None, checkpoint: dict = None):
+    """run_kickoff() on the async engine: both converters run as coroutines on the calling event loop"""
+    try:
+        if CONVERSION_MODE == "cascade":
+            converter = ConverterByCascade(*create_converters(job_id, progress, checkpoint))
+            response = cascade_response(converter, await converter.convert_pdf_async(pdf_path))
         else:
-            # call hook_url with parsing result
-            requests.post(hook_url, json={
-                "status": Status.FAILED,
-                "error": str(e)
-            })
+            converter_gpt, converter_document = create_converters(job_id, progress, checkpoint)
+            # As on the thread engine, a failing converter lets the other finish so its pages are still checkpointed
+            outputs = await asyncio.gather(
+                converter_gpt.convert_pdf_async(pdf_path), converter_document.convert_pdf_async(pdf_path),
+                return_exceptions=True
+            )
+            for output in outputs:
+                if isinstance(output, BaseException):
+                    raise output
+            output_gpt, output_document = outputs
+
+            response = finished_response(converter_gpt, converter_document, output_gpt, output_document)
+    except Exception as e:
+        response = ResponseData(status=Status.FAILED, error=str(e))
+
+    await asyncio.to_thread(deliver_result, job_id, hook_url, response)
+    return response
+
+_engine_runner = None
+
+def run_on_engine(coroutine):
+    """Run a coroutine on this worker process's event loop, kept across jobs so async clients keep their connections"""
+    global _engine_runner
+    if _engine_runner is None:
+        _engine_runner = asyncio.Runner()
+    return _engine_runner.run(coroutine)
+
+def process_job(job: dict):
+    """Worker process entry point: convert a queued upload and return (state, result)"""
+    # Finished pages are checkpointed as they complete, for /status/{job_id}/stream and for retries:
+    # a reclaimed or resumed job only converts what earlier attempts did not finish
+    def save_page(event: dict):
+        job_queue.save_page(
+            job["id"], event["source"], event["index"], event["first_page"], event["last_page"], event["total"],
+            event["markdown"], event["failed"]
+        )
+
+    checkpoint = job_queue.get_checkpoint(job["id"])
+    if ASYNC_ENGINE:
+        # Checkpoints are SQLite writes: one thread records them in order while the event loop carries on,
+        # and leaving the block waits for the last of them before the job is completed
+        with ThreadPoolExecutor(max_workers=1) as checkpoint_writer:
+            progress = Progress(lambda event: checkpoint_writer.submit(save_page, event))
+            response = run_on_engine(run_kickoff_async(job["pdf_path"], job["id"], job["hook_url"], progress, checkpoint))
+    else:
+        response = run_kickoff(job["pdf_path"], job["id"], job["hook_url"], Progress(save_page), checkpoint)
+    return response.status.value, response.model_dump(mode="json", exclude_none=True)
 
 @app.get("/")
 async def root():
@@ -72,35 +239,175 @@ async def root():
 
 @app.post("/kickoff")
 async def convert_pdf_to_markdown(file: UploadFile = File(...)):
+    # Reject instead of queueing when every synchronous slot is busy
+    if not sync_slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many synchronous conversions in progress (limit {MAX_SYNC_JOBS})",
+            headers={"Retry-After": str(SYNC_JOBS_RETRY_AFTER)}
+        )
+
+    try:
+        # Stream the upload to disk instead of holding it in memory for the whole conversion
+        pdf_path = await asyncio.to_thread(spool_upload, file)
+    except Exception as e:
+        sync_slots.release()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if ASYNC_ENGINE:
+        # Cancelled along with this handler when the client disconnects
+        conversion = asyncio.ensure_future(run_kickoff_async(pdf_path, "", ""))
+    else:
+        # A client disconnect cancels this handler but not the thread, which keeps its slot and upload until it finishes
+        conversion = sync_executor.submit(run_kickoff, pdf_path, "", "")
+    conversion.add_done_callback(lambda _: remove_upload(pdf_path))
+    conversion.add_done_callback(lambda _: sync_slots.release())
+
     try:
-        pdf_content = await file.read()
-        return run_kickoff(pdf_content, "", "")
+        return await asyncio.wrap_future(conversion)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+@app.post("/kickoff_stream")
+async def convert_pdf_to_markdown_stream(file: UploadFile = File(...)):
+    """Like /kickoff, but streams each page and chunk as Server-Sent Events, then the full result"""
+    if not sync_slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many synchronous conversions in progress (limit {MAX_SYNC_JOBS})",
+            headers={"Retry-After": str(SYNC_JOBS_RETRY_AFTER)}
+        )
+
+    try:
+        pdf_path = await asyncio.to_thread(spool_upload, file)
+    except Exception as e:
+        sync_slots.release()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    progress = Progress(lambda event: loop.call_soon_threadsafe(events.put_nowait, event))
+
+    # The conversion keeps its slot until it finishes, even if the client disconnects
+    if ASYNC_ENGINE:
+        conversion = asyncio.ensure_future(run_kickoff_async(pdf_path, "", "", progress))
+        background_tasks.add(conversion)
+        conversion.add_done_callback(background_tasks.discard)
+    else:
+        # Callbacks go on the thread's own future, which nothing here can cancel
+        conversion = sync_executor.submit(run_kickoff, pdf_path, "", "", progress)
+    conversion.add_done_callback(lambda _: remove_upload(pdf_path))
+    conversion.add_done_callback(lambda _: sync_slots.release())
+    conversion = asyncio.wrap_future(conversion)
+
+    async def stream():
+        while not (conversion.done() and events.empty()):
+            next_event = asyncio.ensure_future(events.get())
+            done, _ = await asyncio.wait({next_event, conversion}, return_when=asyncio.FIRST_COMPLETED)
+            if next_event in done:
+                event = next_event.result()
+                yield sse("chunk" if event["source"] == "document" else "page", event)
+            else:
+                next_event.cancel()
+
+        response = conversion.result()
+        yield sse("result", response.model_dump(mode="json", exclude_none=True))
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
 @app.post("/kickoff_hook")
-async def convert_pdf_to_markdown(background_tasks: BackgroundTasks, hook_url: str= Form(...), file: UploadFile = File(...)):
+async def convert_pdf_to_markdown(hook_url: str= Form(...), file: UploadFile = File(...)):
     try:
         job_id = str(uuid.uuid4())
-        pdf_content = await file.read()
 
-        background_tasks.add_task(run_kickoff, pdf_content, job_id, hook_url)
-        store[job_id] = ResponseData(status=Status.RUNNING)
+        # The upload is streamed into the spool; the job survives restarts and is picked up by whichever worker is free
+        await asyncio.to_thread(job_queue.enqueue, job_id, file.file, hook_url)
         
         return {"job_id": job_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/cache/stats")
+async def get_cache_stats():
+    return result_cache.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus metrics of this process and every worker process"""
+    return await asyncio.to_thread(metrics.render)
+
+@app.get("/deployments/stats")
+async def get_deployment_stats():
+    return {pool.name: pool.stats() for pool in (ocr_pool, di_pool, document_pool)}
+
+@app.get("/webhooks/stats")
+async def get_webhook_stats():
+    """Deliveries waiting for their next attempt, being sent, or given up on"""
+    return await asyncio.to_thread(webhook_outbox.stats)
+
+@app.post("/resume/{job_id}")
+async def resume_job(job_id: str):
+    """Queue a failed job again; only the pages and chunks it did not finish are converted"""
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    if not await asyncio.to_thread(job_queue.resume, job_id):
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job['state']} and cannot be resumed")
+    return {"job_id": job_id}
+
+@app.get("/status/{job_id}/stream")
+async def stream_status(job_id: str):
+    """Relay a queued job's pages and chunks as Server-Sent Events while it runs, then its result"""
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+    async def stream():
+        after = 0
+        seen = {"gpt": set(), "document": set()}  # A retried job may record a page twice
+        while True:
+            job = await asyncio.to_thread(job_queue.get, job_id)
+            # Read pages after the state so none recorded before the job finished are missed
+            for row in await asyncio.to_thread(job_queue.get_pages, job_id, after):
+                after = row["rowid"]
+                seen[row["source"]].add(row["idx"])
+                yield sse("chunk" if row["source"] == "document" else "page", {
+                    "source": row["source"],
+                    "index": row["idx"],
+                    "first_page": row["first_page"],
+                    "last_page": row["last_page"],
+                    "total": row["total"],
+                    "completed": len(seen[row["source"]]),
+                    "failed": bool(row["failed"]),
+                    "markdown": row["content"]
+                })
+
+            if job is None:
+                return
+            if job["state"] not in (JobState.QUEUED, JobState.RUNNING):
+                if job["state"] == JobState.FINISHED:
+                    await asyncio.to_thread(job_queue.delete, job_id)
+                yield sse("result", {**job["result"], "status": job["state"]})
+                return
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
 @app.get("/status/{job_id}")
 async def get_status(job_id: str):
     try:
-        if job_id not in store:
+        job = await asyncio.to_thread(job_queue.get, job_id)
+        if job is None:
             raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
-        
-        response = store[job_id]
-        if not response.status == Status.RUNNING:
-            del store[job_id]
 
-        return response
+        if job["state"] in (JobState.QUEUED, JobState.RUNNING):
+            return ResponseData(status=Status.RUNNING)
+
+        # Failed jobs stay around (until JOB_FAILED_RETENTION_HOURS) so they can be resumed
+        if job["state"] == JobState.FINISHED:
+            await asyncio.to_thread(job_queue.delete, job_id)
+        return ResponseData(**{**job["result"], "status": job["state"]})
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
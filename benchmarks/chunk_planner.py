@@ -0,0 +1,110 @@
+"""Benchmark for ConverterByDocumentIntelligence.plan_chunks against the previous incremental chunker.
+
+Usage: python benchmarks/chunk_planner.py [pdf_path]
+
+With a PDF path both chunkers run on that file. Without one, synthetic
+scan-sized documents of increasing length are generated so the growth
+in chunking time with page count is visible, followed by a document
+whose pages all share one large image.
+"""
+import io
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+from PyPDF2 import PageObject, PdfReader, PdfWriter
+from PyPDF2.generic import DecodedStreamObject, DictionaryObject, NameObject, NumberObject
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config import CHUNK_SIZE
+from pdf_to_markdown import ConverterByDocumentIntelligence
+
+def legacy_chunks(pdf_reader):
+    """The chunker used before the planner: re-serializes the growing chunk after every page"""
+    max_chunk_size_bytes = CHUNK_SIZE * 1024 * 1024
+    total_pages = len(pdf_reader.pages)
+    chunks = []
+    pdf_writer = PdfWriter()
+    for page_num in range(total_pages):
+        pdf_writer.add_page(pdf_reader.pages[page_num])
+        chunk_bytes = io.BytesIO()
+        pdf_writer.write(chunk_bytes)
+        if len(chunk_bytes.getvalue()) >= max_chunk_size_bytes or page_num == total_pages - 1:
+            chunks.append(chunk_bytes.getvalue())
+            pdf_writer = PdfWriter()
+    return chunks
+
+def planned_chunks(pdf_reader):
+    converter = ConverterByDocumentIntelligence()
+    return [converter.build_chunk(pdf_reader, page_nums) for page_nums in converter.plan_chunks(pdf_reader)]
+
+def synthetic_pdf(pages, page_kb=80):
+    """A document whose pages carry incompressible content streams, like scanned pages"""
+    rnd = random.Random(pages)
+    pdf_writer = PdfWriter()
+    for _ in range(pages):
+        page = PageObject.create_blank_page(None, 612, 792)
+        stream = DecodedStreamObject()
+        stream.set_data(b"% " + rnd.randbytes(page_kb * 1024).hex().encode()[:page_kb * 1024])
+        page[NameObject('/Contents')] = stream
+        pdf_writer.add_page(page)
+    pdf_bytes = io.BytesIO()
+    pdf_writer.write(pdf_bytes)
+    return pdf_bytes.getvalue()
+
+def shared_image_pdf(pages, image_kb=2048):
+    """A document whose pages all draw the same large image, stored once, like a letterhead or a form background"""
+    rnd = random.Random(pages)
+    pdf_writer = PdfWriter()
+    image = DecodedStreamObject()
+    image.set_data(rnd.randbytes(image_kb * 1024))
+    image.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Image'),
+        NameObject('/Width'): NumberObject(1024),
+        NameObject('/Height'): NumberObject(image_kb),
+        NameObject('/ColorSpace'): NameObject('/DeviceGray'),
+        NameObject('/BitsPerComponent'): NumberObject(8)
+    })
+    image_ref = pdf_writer._add_object(image)
+    for _ in range(pages):
+        page = PageObject.create_blank_page(None, 612, 792)
+        page[NameObject('/Resources')] = DictionaryObject({
+            NameObject('/XObject'): DictionaryObject({NameObject('/Im0'): image_ref})
+        })
+        stream = DecodedStreamObject()
+        stream.set_data(b"q 612 0 0 792 0 0 cm /Im0 Do Q")
+        page[NameObject('/Contents')] = stream
+        pdf_writer.add_page(page)
+    pdf_bytes = io.BytesIO()
+    pdf_writer.write(pdf_bytes)
+    return pdf_bytes.getvalue()
+
+def run(label, pdf_content):
+    timings = []
+    for chunker in (legacy_chunks, planned_chunks):
+        pdf_reader = PdfReader(io.BytesIO(pdf_content))
+        start = time.perf_counter()
+        chunks = chunker(pdf_reader)
+        timings.append((time.perf_counter() - start, len(chunks)))
+    (legacy_time, legacy_count), (planned_time, planned_count) = timings
+    print(f"{label:>12}  legacy {legacy_time:7.2f} s ({legacy_count} chunks)  "
+          f"planned {planned_time:7.2f} s ({planned_count} chunks)  speedup {legacy_time / planned_time:6.1f}x")
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as f:
+            run(os.path.basename(sys.argv[1]), f.read())
+        return
+
+    for pages in (25, 50, 100, 200, 400):
+        run(f"{pages} pages", synthetic_pdf(pages))
+
+    # Shared resources must count once per chunk, not once per page
+    run("shared image", shared_image_pdf(50))
+
+if __name__ == '__main__':
+    main()
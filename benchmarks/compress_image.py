@@ -0,0 +1,118 @@
+"""Micro-benchmark for ConverterByGPT.compress_image against the previous trial-and-error compressor.
+
+Usage: python benchmarks/compress_image.py [page_dir]
+
+page_dir should contain rendered page images (PNG/JPEG). Without it a small
+synthetic corpus of clean and noisy scan-like pages is generated.
+"""
+import io
+import math
+import os
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image, ImageDraw, ImageEnhance
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config import MAX_IMAGE_SIZE_MB
+from pdf_to_markdown import ConverterByGPT
+
+def legacy_compress_image(image, target_size_mb=MAX_IMAGE_SIZE_MB):
+    """The compressor used before the predictive rewrite, kept here for comparison"""
+    def get_size_mb(img):
+        img_byte_arr = io.BytesIO()
+        img.save(img_byte_arr, format='PNG')
+        return len(img_byte_arr.getvalue()) / (1024 * 1024)
+
+    current_size_mb = get_size_mb(image)
+    if current_size_mb <= target_size_mb:
+        return image
+
+    quality = 95
+    compressed_image = image
+    while current_size_mb > target_size_mb and quality > 5:
+        img_byte_arr = io.BytesIO()
+        compressed_image = image.convert('RGB') if image.mode in ('RGBA', 'P') else image
+        compressed_image.save(img_byte_arr, format='JPEG', quality=quality, optimize=True)
+        current_size_mb = len(img_byte_arr.getvalue()) / (1024 * 1024)
+        quality -= 10
+
+    scale_factor = 1.0
+    while current_size_mb > target_size_mb and scale_factor > 0.1:
+        scale_factor *= 0.7
+        new_width = int(image.width * scale_factor)
+        new_height = int(image.height * scale_factor)
+        compressed_image = compressed_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        current_size_mb = get_size_mb(compressed_image)
+
+    final_size = get_size_mb(compressed_image)
+    if final_size > target_size_mb:
+        scale_factor = math.sqrt(target_size_mb / final_size) * 0.9
+        new_width = int(image.width * scale_factor)
+        new_height = int(image.height * scale_factor)
+        compressed_image = compressed_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    get_size_mb(compressed_image)
+    return compressed_image
+
+def synthetic_corpus():
+    """Clean text pages plus noisy photo-like scans that overflow the PNG budget"""
+    pages = []
+    for i in range(4):
+        image = Image.new('L', (1700, 2200), 255)
+        draw = ImageDraw.Draw(image)
+        for y in range(100, 2100, 30):
+            draw.text((100, y), f"Part {i}. Information About You " * 4, fill=0)
+        pages.append(image)
+    for i in range(4):
+        noise = Image.effect_noise((2550, 3300), 40 + 10 * i)
+        pages.append(Image.blend(noise, Image.linear_gradient('L').resize((2550, 3300)), 0.3))
+    return pages
+
+def load_corpus(page_dir):
+    pages = []
+    for path in sorted(Path(page_dir).iterdir()):
+        if path.suffix.lower() in ('.png', '.jpg', '.jpeg'):
+            with Image.open(path) as image:
+                pages.append(ImageEnhance.Contrast(image.convert('L')).enhance(2.0))
+    return pages
+
+def count_encodes(func, pages):
+    """Run func over pages and return (seconds, encode count)"""
+    original_save = Image.Image.save
+    encodes = 0
+
+    def counting_save(self, *args, **kwargs):
+        nonlocal encodes
+        encodes += 1
+        return original_save(self, *args, **kwargs)
+
+    Image.Image.save = counting_save
+    try:
+        start = time.perf_counter()
+        for page in pages:
+            func(page)
+        return time.perf_counter() - start, encodes
+    finally:
+        Image.Image.save = original_save
+
+def main():
+    pages = load_corpus(sys.argv[1]) if len(sys.argv) > 1 else synthetic_corpus()
+    print(f"Benchmarking {len(pages)} pages (target {MAX_IMAGE_SIZE_MB} MB)")
+
+    # Silence the compressor's progress output while timing
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            legacy_time, legacy_encodes = count_encodes(legacy_compress_image, pages)
+            new_time, new_encodes = count_encodes(ConverterByGPT.compress_image, pages)
+        finally:
+            sys.stdout = stdout
+
+    print(f"legacy:     {legacy_time:8.2f} s  {legacy_encodes:4d} encodes  ({legacy_encodes / len(pages):.1f} per page)")
+    print(f"predictive: {new_time:8.2f} s  {new_encodes:4d} encodes  ({new_encodes / len(pages):.1f} per page)")
+    print(f"speedup:    {legacy_time / new_time:8.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from config import *
+
+def content_hash(content):
+    """SHA-256 hex digest of bytes or text"""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+def file_hash(path: str, block_size: int = 1024 * 1024):
+    """SHA-256 hex digest of a file, read in blocks; equal to content_hash() of its bytes"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def make_cache_key(*parts):
+    """Build a cache key from its parts; PROMPT_VERSION is always included so a bump invalidates everything"""
+    return content_hash("|".join(str(part) for part in (PROMPT_VERSION, *parts)))
+
+class ResultCache:
+    """Two-tier content-addressed cache: an in-memory LRU in front of a size-bounded on-disk store"""
+    def __init__(self, cache_dir: str = CACHE_DIR, max_memory_mb: float = CACHE_MAX_MEMORY_MB, max_disk_mb: float = CACHE_MAX_DISK_MB):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024
+        self.max_disk_bytes = max_disk_mb * 1024 * 1024
+
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = None  # Measured lazily on first write
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()  # One eviction pass at a time
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "sets": 0, "evictions": 0}
+
+    def _path(self, key: str):
+        # Shard by key prefix so no directory grows too large
+        return Path(self.cache_dir) / key[:2] / key
+
+    def get(self, key: str):
+        """Return the cached value or None"""
+        if not CACHE_ENABLED:
+            return None
+
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return self.memory[key]
+
+        path = self._path(key)
+        try:
+            value = path.read_text(encoding='utf-8')
+            os.utime(path)  # Refresh recency for disk eviction
+        except OSError:
+            with self.lock:
+                self.counters["misses"] += 1
+            return None
+
+        with self.lock:
+            self.counters["disk_hits"] += 1
+            self._remember(key, value)
+        return value
+
+    def set(self, key: str, value: str):
+        """Store a value in both tiers"""
+        if not CACHE_ENABLED or value is None:
+            return
+
+        with self.lock:
+            self.counters["sets"] += 1
+            self._remember(key, value)
+
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Write then rename so concurrent readers never see a partial file
+            temp_path = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+            temp_path.write_text(value, encoding='utf-8')
+            try:
+                replaced_bytes = path.stat().st_size
+            except OSError:
+                replaced_bytes = 0
+            os.replace(temp_path, path)
+            self._account_disk(path.stat().st_size - replaced_bytes)
+        except OSError as e:
+            print(f"Could not write cache entry {key}: {str(e)}")
+
+    def _remember(self, key: str, value: str):
+        """Insert into the memory tier, evicting least recently used entries (caller holds the lock)"""
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        self.memory[key] = value
+        self.memory_bytes += len(value)
+        while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def _disk_files(self):
+        files = []
+        for f in Path(self.cache_dir).glob("*/*"):
+            try:
+                files.append((f, f.stat()))
+            except OSError:
+                pass  # Evicted or renamed meanwhile
+        return files
+
+    def _account_disk(self, added_bytes: int):
+        """Track the size of the disk tier and evict when it is over budget; directory scans run outside the lock"""
+        with self.lock:
+            measured = self.disk_bytes is not None
+            if measured:
+                self.disk_bytes += added_bytes
+        if not measured:
+            disk_bytes = sum(stat.st_size for _, stat in self._disk_files())
+            with self.lock:
+                if self.disk_bytes is None:
+                    self.disk_bytes = disk_bytes
+                else:
+                    self.disk_bytes += added_bytes
+        with self.lock:
+            if self.disk_bytes <= self.max_disk_bytes:
+                return
+
+        if not self.evict_lock.acquire(blocking=False):
+            return  # Another writer is already evicting
+        try:
+            # Evict the least recently used files until the store is back under 90% of its budget
+            files = sorted(self._disk_files(), key=lambda item: item[1].st_mtime)
+            total = sum(stat.st_size for _, stat in files)
+            evictions = 0
+            for f, stat in files:
+                if total <= self.max_disk_bytes * 0.9:
+                    break
+                try:
+                    f.unlink()
+                    total -= stat.st_size
+                    evictions += 1
+                except OSError:
+                    pass
+            with self.lock:
+                self.disk_bytes = total
+                self.counters["evictions"] += evictions
+        finally:
+            self.evict_lock.release()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            return {
+                **self.counters,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_items": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "disk_bytes": self.disk_bytes,
+                "prompt_version": PROMPT_VERSION
+            }
+
+# Shared by every job in the process
+result_cache = ResultCache()
@@ -18,24 +18,138 @@ DI_AZURE_DEPLOYMENT_NAME = os.getenv('DI_AZURE_DEPLOYMENT_NAME')
 AZURE_DOCUMENT_ENDPOINT = os.getenv('AZURE_DOCUMENT_ENDPOINT')
 AZURE_DOCUMENT_KEY = os.getenv('AZURE_DOCUMENT_KEY')
 
+# Optional pools of equivalent deployments, as JSON lists of objects with "endpoint", "key", "deployment",
+# "api_version", "weight", "tokens_per_minute", "requests_per_minute" and "name"; missing fields fall back
+# to the single-deployment settings above
+OCR_DEPLOYMENTS = os.getenv('OCR_DEPLOYMENTS', '')
+DI_DEPLOYMENTS = os.getenv('DI_DEPLOYMENTS', '')
+DOCUMENT_ENDPOINTS = os.getenv('DOCUMENT_ENDPOINTS', '')
+
+# Circuit breaker: eject a deployment after this many consecutive failures, probe it again after the cooldown
+CIRCUIT_BREAKER_FAILURES = int(os.getenv('CIRCUIT_BREAKER_FAILURES', '5'))
+CIRCUIT_BREAKER_COOLDOWN = int(os.getenv('CIRCUIT_BREAKER_COOLDOWN', '30'))  # Seconds
+
 # Next API Key
 NEXT_API_KEY = os.getenv('NEXT_API_KEY')
 
-# Temporary directory for storing PNG files
+# Temporary directory for spooled uploads and spilled page payloads
 TEMP_DIR = "temp"
+UPLOAD_SPOOL_DIR = f"{TEMP_DIR}/uploads"  # Uploads of synchronous conversions, removed once they finish
+UPLOAD_BLOCK_SIZE = 1024 * 1024  # Uploads are copied to disk in blocks of this many bytes, never read whole
+
+# Page payloads are kept in memory; set SPILL_TO_DISK to park them in TEMP_DIR
+# whenever available memory drops below SPILL_MEMORY_THRESHOLD_MB
+SPILL_TO_DISK = os.getenv('SPILL_TO_DISK', 'False').lower() in ('true', '1')
+SPILL_MEMORY_THRESHOLD_MB = int(os.getenv('SPILL_MEMORY_THRESHOLD_MB', '1024'))
 
 # Image processing settings
 MAX_IMAGE_SIZE_MB = 5
-TARGET_IMAGE_SIZE_MB = 4.5  # Slightly below max for safety margin
+JPEG_QUALITY = 85  # Quality used when a page has to fall back from PNG to JPEG
+
+# Streaming rasterization settings
+RENDER_WINDOW_SIZE = int(os.getenv('RENDER_WINDOW_SIZE', '4'))  # Pages rendered per poppler call, 0 renders the whole document at once
+
+# Process pool for CPU-bound rendering and preprocessing, 0 preprocesses pages in the calling thread
+PREPROCESS_WORKERS = int(os.getenv('PREPROCESS_WORKERS', str(os.cpu_count() or 1)))
+
+# Native-text fast path: pages with a usable text layer and no form widgets or images skip vision OCR
+NATIVE_TEXT_FAST_PATH = os.getenv('NATIVE_TEXT_FAST_PATH', 'True').lower() in ('true', '1')
+NATIVE_TEXT_MIN_CHARS = int(os.getenv('NATIVE_TEXT_MIN_CHARS', '200'))  # Minimum extracted characters for a text layer to count as usable
+NATIVE_TEXT_LLM_FORMAT = os.getenv('NATIVE_TEXT_LLM_FORMAT', 'True').lower() in ('true', '1')  # Structure extracted text with a text-only LLM call
+
+# Blank and near-duplicate page detection, run on the grayscale page before any LLM call
+SKIP_BLANK_PAGES = os.getenv('SKIP_BLANK_PAGES', 'True').lower() in ('true', '1')
+BLANK_PAGE_MAX_INK = float(os.getenv('BLANK_PAGE_MAX_INK', '0.0005'))  # Max fraction of dark pixels for a blank page
+BLANK_PAGE_MARKDOWN = "**Document Name:** Blank Page\n\nThis page is blank. There is no information, fields, or instructions to extract from this page."
+DEDUPLICATE_PAGES = os.getenv('DEDUPLICATE_PAGES', 'True').lower() in ('true', '1')
+DUPLICATE_PAGE_MAX_INK = float(os.getenv('DUPLICATE_PAGE_MAX_INK', '0.02'))  # Only sparse pages such as cover sheets are eligible for reuse
+DUPLICATE_PAGE_MAX_DISTANCE = int(os.getenv('DUPLICATE_PAGE_MAX_DISTANCE', '48'))  # Max differing bits between 1024-bit page hashes
+
+# Send several page images in one vision request (1 disables batching)
+VISION_BATCH_SIZE = int(os.getenv('VISION_BATCH_SIZE', '1'))
+VISION_BATCH_MAX_IMAGE_TOKENS = int(os.getenv('VISION_BATCH_MAX_IMAGE_TOKENS', '8000'))  # Estimated image tokens per batch
+
+# Content-addressed result cache for whole documents, pages and Document Intelligence chunks
+CACHE_ENABLED = os.getenv('CACHE_ENABLED', 'True').lower() in ('true', '1')
+CACHE_DIR = os.getenv('CACHE_DIR', 'cache')
+CACHE_MAX_MEMORY_MB = int(os.getenv('CACHE_MAX_MEMORY_MB', '256'))
+CACHE_MAX_DISK_MB = int(os.getenv('CACHE_MAX_DISK_MB', '2048'))
+PROMPT_VERSION = "3"  # Bump whenever a prompt changes so cached results are invalidated
+
+# System prompt for vision OCR: 'full' (with worked examples) or 'compact' (rules and format only)
+OCR_PROMPT_VARIANT = os.getenv('OCR_PROMPT_VARIANT', 'full').lower()
 
 # Threading settings
 MAX_THREADS = 50  # Maximum number of concurrent API calls
 
+# Convert on the asyncio engine: async SDK clients and one coroutine per page instead of one thread per page.
+# MAX_THREADS still bounds the pages of one job in flight; False keeps the thread pool engine
+ASYNC_ENGINE = os.getenv('ASYNC_ENGINE', 'True').lower() in ('true', '1')
+
+# Adaptive (AIMD) concurrency for OCR calls, shared by every job in the process: grows by one
+# per round of successful calls, shrinks on 429s or latency spikes
+AIMD_INITIAL_CONCURRENCY = int(os.getenv('AIMD_INITIAL_CONCURRENCY', '8'))
+AIMD_MIN_CONCURRENCY = int(os.getenv('AIMD_MIN_CONCURRENCY', '1'))
+AIMD_MAX_CONCURRENCY = int(os.getenv('AIMD_MAX_CONCURRENCY', str(MAX_THREADS)))
+AIMD_DECREASE_FACTOR = float(os.getenv('AIMD_DECREASE_FACTOR', '0.5'))
+AIMD_LATENCY_SPIKE_FACTOR = float(os.getenv('AIMD_LATENCY_SPIKE_FACTOR', '3'))  # A call this many times slower per estimated token than the average counts as congestion
+
+# Keep-alive connection pools of the process-wide SDK clients
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', str(MAX_THREADS)))  # Connections kept open per endpoint
+HTTP_KEEPALIVE_SECONDS = int(os.getenv('HTTP_KEEPALIVE_SECONDS', '60'))
+
+# Durable job queue for /kickoff_hook, consumed by worker processes
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', 'data/jobs.db')
+JOB_SPOOL_DIR = os.getenv('JOB_SPOOL_DIR', 'data/uploads')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))  # Worker processes started with the API, 0 when they run separately via worker.py
+JOB_LEASE_SECONDS = 60  # A running job is handed to another worker if its lease is not renewed in time
+JOB_MAX_ATTEMPTS = 3
+JOB_POLL_INTERVAL = 1  # Seconds between queue polls when idle
+METRICS_DIR = os.getenv('METRICS_DIR', 'data/metrics')  # Worker processes publish their metrics here for /metrics
+JOB_FAILED_RETENTION_HOURS = float(os.getenv('JOB_FAILED_RETENTION_HOURS', '24'))  # Failed jobs can be resumed until they are purged
+JOB_FINISHED_RETENTION_HOURS = float(os.getenv('JOB_FINISHED_RETENTION_HOURS', '24'))  # Finished jobs whose result is never read
+
+# Webhook delivery: results of /kickoff_hook jobs go to an outbox in JOB_DB_PATH and are posted by the API
+# (or worker.py) on a pooled async client, retried with exponential backoff until WEBHOOK_MAX_ATTEMPTS
+WEBHOOK_TIMEOUT_SECONDS = float(os.getenv('WEBHOOK_TIMEOUT_SECONDS', '30'))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '8'))
+WEBHOOK_RETRY_DELAY = float(os.getenv('WEBHOOK_RETRY_DELAY', '5'))  # Seconds before the first retry, doubled after every failure
+WEBHOOK_RETRY_MAX_DELAY = float(os.getenv('WEBHOOK_RETRY_MAX_DELAY', '600'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '20'))  # Deliveries in flight across all receivers
+WEBHOOK_MAX_PER_HOST = int(os.getenv('WEBHOOK_MAX_PER_HOST', '4'))  # Deliveries in flight to one receiving host
+WEBHOOK_GZIP = os.getenv('WEBHOOK_GZIP', 'False').lower() in ('true', '1')  # Receivers must accept Content-Encoding: gzip
+WEBHOOK_GZIP_MIN_BYTES = int(os.getenv('WEBHOOK_GZIP_MIN_BYTES', '65536'))  # Smaller bodies are sent uncompressed
+WEBHOOK_LEASE_SECONDS = 300  # A claimed delivery is picked up again if its dispatcher stops before finishing it
+WEBHOOK_POLL_INTERVAL = 1  # Seconds between outbox polls
+
+# Synchronous /kickoff conversions run off the event loop; extra requests get 429 with Retry-After
+MAX_SYNC_JOBS = int(os.getenv('MAX_SYNC_JOBS', '4'))
+SYNC_JOBS_RETRY_AFTER = 30  # Seconds
+
 # Save to markdown file
 SAVE_TO_MARKDOWN = os.getenv('SAVE_TO_MARKDOWN', 'False').lower() in ('true', '1')
 
+# Conversion mode: 'dual' runs vision GPT and Document Intelligence over every page and returns both outputs;
+# 'cascade' runs Document Intelligence first and sends only the pages it reads poorly to vision GPT
+CONVERSION_MODE = os.getenv('CONVERSION_MODE', 'dual').lower()
+CASCADE_MIN_WORD_CONFIDENCE = float(os.getenv('CASCADE_MIN_WORD_CONFIDENCE', '0.9'))  # Pages whose mean word confidence is lower escalate
+CASCADE_MIN_SELECTION_MARK_CONFIDENCE = float(os.getenv('CASCADE_MIN_SELECTION_MARK_CONFIDENCE', '0.8'))  # As do pages with a less certain checkbox
+CASCADE_ESCALATE_HANDWRITING = os.getenv('CASCADE_ESCALATE_HANDWRITING', 'True').lower() in ('true', '1')
+
 # Format raw markdown from Document Intelligence
 FORMAT_RAW_MARKDOWN_FROM_DI = os.getenv('FORMAT_RAW_MARKDOWN_FROM_DI', 'False').lower() in ('true', '1')
+# It is formatted in windows of whole pages, split on Document Intelligence page breaks and run concurrently
+FORMAT_WINDOW_PAGES = int(os.getenv('FORMAT_WINDOW_PAGES', '4'))
+FORMAT_WINDOW_TOKENS = int(os.getenv('FORMAT_WINDOW_TOKENS', '8000'))  # Estimated markdown tokens per window
+FORMAT_MAX_CONCURRENT_WINDOWS = int(os.getenv('FORMAT_MAX_CONCURRENT_WINDOWS', '8'))
+
+# Default rate limits per Azure OpenAI deployment, enforced across all jobs (0 disables a limit)
+OCR_TOKENS_PER_MINUTE = int(os.getenv('OCR_TOKENS_PER_MINUTE', '0'))
+OCR_REQUESTS_PER_MINUTE = int(os.getenv('OCR_REQUESTS_PER_MINUTE', '0'))
+DI_TOKENS_PER_MINUTE = int(os.getenv('DI_TOKENS_PER_MINUTE', '0'))
+DI_REQUESTS_PER_MINUTE = int(os.getenv('DI_REQUESTS_PER_MINUTE', '0'))
+ESTIMATED_COMPLETION_TOKENS = 1500  # Reserved per request until the actual usage is known
+RATE_LIMIT_DB_PATH = os.getenv('RATE_LIMIT_DB_PATH', '')  # Set to share the budgets across worker processes
 
 # Retry settings for handling rate limit errors
 RATE_LIMIT_RETRY_MAX_COUNT = 5
@@ -43,4 +157,6 @@ RATE_LIMIT_RETRY_DELAY = 2
 
 # Chunk size for Document Intelligence
 CHUNK_SIZE = 6  # Maximum size in MB per chunk
+PDF_OBJECT_OVERHEAD = 64  # Bytes per object for its obj/endobj wrapper and xref entry when sizing chunks
+DI_MAX_CONCURRENT_CHUNKS = int(os.getenv('DI_MAX_CONCURRENT_CHUNKS', '4'))  # Chunks analyzed at the same time per document
 
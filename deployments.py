@@ -0,0 +1,253 @@
+import asyncio
+import json
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from openai import AsyncAzureOpenAI, AzureOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient as AsyncDocumentIntelligenceClient
+from config import *
+from rate_limit import AdaptiveConcurrency, RateLimiter
+
+try:
+    import httpx
+except ImportError:  # Newer openai releases ship their HTTP stack as httpx2
+    import httpx2 as httpx
+
+def is_transient(error):
+    """Server errors, timeouts and dropped connections, which another deployment may not have"""
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status == 408 or status >= 500
+    message = f"{type(error).__name__} {error}".lower()
+    return any(word in message for word in ("timeout", "timed out", "eof", "connection"))
+
+def http_limits():
+    return httpx.Limits(
+        max_connections=HTTP_POOL_SIZE,
+        max_keepalive_connections=HTTP_POOL_SIZE,
+        keepalive_expiry=HTTP_KEEPALIVE_SECONDS
+    )
+
+def create_openai_client(member):
+    """Azure OpenAI client with a keep-alive pool; SDK retries are off so 429s reach our own backoff and AIMD gate"""
+    return AzureOpenAI(
+        azure_endpoint=member.endpoint,
+        api_key=member.key,
+        api_version=member.api_version,
+        max_retries=0,
+        http_client=DefaultHttpxClient(limits=http_limits())
+    )
+
+def create_async_openai_client(member):
+    """Async counterpart of create_openai_client for the async engine"""
+    return AsyncAzureOpenAI(
+        azure_endpoint=member.endpoint,
+        api_key=member.key,
+        api_version=member.api_version,
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(limits=http_limits())
+    )
+
+def create_document_client(member):
+    """Document Intelligence client on a pooled requests session"""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE))
+    return DocumentIntelligenceClient(
+        endpoint=member.endpoint,
+        credential=AzureKeyCredential(member.key),
+        transport=RequestsTransport(session=session, session_owner=False)
+    )
+
+def create_async_document_client(member):
+    """Document Intelligence aio client on a pooled aiohttp session (aiohttp is only needed by the async engine)"""
+    import aiohttp
+    from azure.core.pipeline.transport import AioHttpTransport
+
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=HTTP_KEEPALIVE_SECONDS))
+    return AsyncDocumentIntelligenceClient(
+        endpoint=member.endpoint,
+        credential=AzureKeyCredential(member.key),
+        transport=AioHttpTransport(session=session)
+    )
+
+class Deployment:
+    """One member of a pool with its own quota, optional concurrency gate and circuit breaker state"""
+    def __init__(self, name: str, endpoint: str, key: str, deployment: str = None, api_version: str = None,
+                 weight: float = 1, tokens_per_minute: int = 0, requests_per_minute: int = 0, adaptive: bool = False,
+                 client_factory=create_openai_client, async_client_factory=create_async_openai_client):
+        self.name = name
+        self.endpoint = endpoint
+        self.key = key
+        self.deployment = deployment
+        self.api_version = api_version
+        self.weight = max(float(weight), 0.01)
+        self.limiter = RateLimiter(name, int(tokens_per_minute), int(requests_per_minute))
+        self.concurrency = AdaptiveConcurrency(name, AIMD_INITIAL_CONCURRENCY, AIMD_MIN_CONCURRENCY, AIMD_MAX_CONCURRENCY) if adaptive else None
+
+        self.active = 0  # Requests currently routed here, including those waiting on the limiter
+        self.failures = 0  # Consecutive transient failures
+        self.open_until = 0.0  # Ejected until this time once failures reach CIRCUIT_BREAKER_FAILURES
+        self.probing = False
+
+        self.client_factory = client_factory
+        self.client = None
+        self.client_lock = threading.Lock()
+        self.async_client_factory = async_client_factory
+        self.async_clients = weakref.WeakKeyDictionary()  # Event loop -> async SDK client
+
+    def get_client(self):
+        """Process-lifetime SDK client for this member, shared across threads and created on first use"""
+        with self.client_lock:
+            if self.client is None:
+                self.client = self.client_factory(self)
+            return self.client
+
+    def get_async_client(self):
+        """Async SDK client for this member, one per event loop because async connections belong to the loop that opened them"""
+        loop = asyncio.get_running_loop()
+        with self.client_lock:
+            client = self.async_clients.get(loop)
+            if client is None:
+                client = self.async_clients[loop] = self.async_client_factory(self)
+            return client
+
+    async def close_async_client(self):
+        """Close the async client of the running event loop, if it opened one"""
+        with self.client_lock:
+            client = self.async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+    def is_paused(self, now: float):
+        return self.concurrency is not None and self.concurrency.paused_until > now
+
+    def stats(self):
+        stats = {
+            "endpoint": self.endpoint,
+            "deployment": self.deployment,
+            "weight": self.weight,
+            "active": self.active,
+            "failures": self.failures,
+            "ejected": self.open_until > time.time(),
+            "rate_limit": self.limiter.stats()
+        }
+        if self.concurrency is not None:
+            stats["concurrency"] = self.concurrency.stats()
+        return stats
+
+class DeploymentPool:
+    """Routes each request to the least-loaded healthy member of a pool of equivalent deployments"""
+    def __init__(self, name: str, members):
+        self.name = name
+        self.members = members
+        self.lock = threading.Lock()
+
+    @property
+    def size(self):
+        return len(self.members)
+
+    @property
+    def model_key(self):
+        """Identifies the model behind the pool for cache keys; members are expected to be equivalent"""
+        return "|".join(sorted({str(member.deployment) for member in self.members}))
+
+    def choose(self, avoid=()):
+        """Pick a member, skipping those named in avoid (already tried by this request) while others are healthy"""
+        with self.lock:
+            now = time.time()
+            healthy = [member for member in self.members if member.open_until <= now and not member.probing]
+            available = [member for member in healthy if member.name not in avoid] or healthy
+            if not available:
+                # Every member is ejected: probe the one due back first rather than failing the request
+                available = [min(self.members, key=lambda member: member.open_until)]
+
+            # Prefer members that are not paused by a Retry-After, then the lowest load per unit of weight
+            member = min(available, key=lambda member: (member.is_paused(now), (member.active + 1) / member.weight))
+            if member.failures >= CIRCUIT_BREAKER_FAILURES:
+                member.probing = True  # Half-open: only this request tests the member
+            member.active += 1
+            return member
+
+    def release(self, member, error=None):
+        """Record the outcome of a request; only transient errors count towards ejection"""
+        with self.lock:
+            member.active -= 1
+            member.probing = False
+            if error is None or not is_transient(error):
+                if member.failures >= CIRCUIT_BREAKER_FAILURES:
+                    print(f">>>> {member.name} is back in the {self.name} pool")
+                member.failures = 0
+                member.open_until = 0.0
+                return
+
+            member.failures += 1
+            if member.failures >= CIRCUIT_BREAKER_FAILURES:
+                member.open_until = time.time() + CIRCUIT_BREAKER_COOLDOWN
+                print(f">>>> {member.name} ejected from the {self.name} pool for {CIRCUIT_BREAKER_COOLDOWN}s after {member.failures} failures")
+
+    @contextmanager
+    def use(self, avoid=()):
+        """Hold a member for the duration of one request"""
+        member = self.choose(avoid)
+        try:
+            yield member
+        except Exception as e:
+            self.release(member, e)
+            raise
+        except BaseException:
+            # A cancelled async request hands its member back without counting as a failure
+            self.release(member)
+            raise
+        self.release(member)
+
+    def warm_up(self):
+        """Create every member's client ahead of the first request"""
+        for member in self.members:
+            member.get_client()
+
+    async def close_async_clients(self):
+        for member in self.members:
+            await member.close_async_client()
+
+    def stats(self):
+        with self.lock:
+            return {member.name: member.stats() for member in self.members}
+
+def load_pool(name: str, spec: str, default: dict, adaptive: bool = False, client_factory=create_openai_client,
+              async_client_factory=create_async_openai_client):
+    """Build a pool from a JSON list of members, or a single member from the default settings"""
+    entries = json.loads(spec) if spec else [{}]
+    members = []
+    for index, entry in enumerate(entries):
+        settings = {**default, **entry}
+        settings.setdefault("name", name if len(entries) == 1 else f"{name}-{index}")
+        members.append(Deployment(adaptive=adaptive, client_factory=client_factory, async_client_factory=async_client_factory, **settings))
+    return DeploymentPool(name, members)
+
+# Process-wide pools, shared by every job
+ocr_pool = load_pool("ocr", OCR_DEPLOYMENTS, {
+    "endpoint": OCR_AZURE_OPENAI_ENDPOINT,
+    "key": OCR_AZURE_OPENAI_KEY,
+    "deployment": OCR_AZURE_DEPLOYMENT_NAME,
+    "api_version": OCR_AZURE_OPENAI_API_VERSION,
+    "tokens_per_minute": OCR_TOKENS_PER_MINUTE,
+    "requests_per_minute": OCR_REQUESTS_PER_MINUTE
+}, adaptive=True)
+di_pool = load_pool("di", DI_DEPLOYMENTS, {
+    "endpoint": DI_AZURE_OPENAI_ENDPOINT,
+    "key": DI_AZURE_OPENAI_KEY,
+    "deployment": DI_AZURE_DEPLOYMENT_NAME,
+    "api_version": DI_AZURE_OPENAI_API_VERSION,
+    "tokens_per_minute": DI_TOKENS_PER_MINUTE,
+    "requests_per_minute": DI_REQUESTS_PER_MINUTE
+})
+document_pool = load_pool("document", DOCUMENT_ENDPOINTS, {
+    "endpoint": AZURE_DOCUMENT_ENDPOINT,
+    "key": AZURE_DOCUMENT_KEY
+}, client_factory=create_document_client, async_client_factory=create_async_document_client)
@@ -0,0 +1,284 @@
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from pathlib import Path
+from config import *
+from metrics import metrics
+
+class JobState:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    hook_url TEXT NOT NULL DEFAULT '',
+    pdf_path TEXT NOT NULL,
+    result TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state_created ON jobs (state, created_at);
+CREATE TABLE IF NOT EXISTS job_pages (
+    job_id TEXT NOT NULL,
+    source TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    first_page INTEGER NOT NULL,
+    last_page INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    failed INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (job_id, source, idx)
+);
+"""
+
+class JobQueue:
+    """Durable SQLite-backed job queue shared by the API processes and the worker processes"""
+    def __init__(self, db_path: str = JOB_DB_PATH, spool_dir: str = JOB_SPOOL_DIR):
+        self.db_path = db_path
+        self.spool_dir = spool_dir
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        Path(spool_dir).mkdir(parents=True, exist_ok=True)
+
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        # Autocommit mode; writes that must be atomic use explicit BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, job_id: str, pdf_file, hook_url: str = ""):
+        """Spool the upload, a binary file object copied block by block, and queue the job"""
+        pdf_path = os.path.join(self.spool_dir, f"{job_id}.pdf")
+        with open(pdf_path, "wb") as f:
+            shutil.copyfileobj(pdf_file, f, UPLOAD_BLOCK_SIZE)
+
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, state, hook_url, pdf_path, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, JobState.QUEUED, hook_url, pdf_path, now, now)
+            )
+
+    def claim(self, worker: str):
+        """Atomically take the oldest queued job, or a running job whose worker stopped renewing its lease"""
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                while True:
+                    now = time.time()
+                    row = conn.execute(
+                        "SELECT * FROM jobs WHERE state = ? OR (state = ? AND lease_expires_at < ?) ORDER BY created_at LIMIT 1",
+                        (JobState.QUEUED, JobState.RUNNING, now)
+                    ).fetchone()
+                    if row is None:
+                        conn.execute("COMMIT")
+                        return None
+
+                    if row["attempts"] < JOB_MAX_ATTEMPTS:
+                        break
+
+                    # The job keeps killing its worker; give up on it (its upload is kept for /resume)
+                    conn.execute(
+                        "UPDATE jobs SET state = ?, result = ?, lease_expires_at = NULL, updated_at = ? WHERE id = ?",
+                        (JobState.FAILED, json.dumps({"error": f"Job abandoned after {row['attempts']} attempts"}), now, row["id"])
+                    )
+
+                conn.execute(
+                    "UPDATE jobs SET state = ?, worker = ?, attempts = attempts + 1, lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                    (JobState.RUNNING, worker, now + JOB_LEASE_SECONDS, now, row["id"])
+                )
+                conn.execute("COMMIT")
+                return dict(row)
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def renew_lease(self, job_id: str, worker: str):
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND worker = ? AND state = ?",
+                (time.time() + JOB_LEASE_SECONDS, job_id, worker, JobState.RUNNING)
+            )
+
+    def complete(self, job_id: str, state: str, result: dict):
+        """Record the final state and result of a job; the upload of a failed job is kept so it can be resumed"""
+        with self.connect() as conn:
+            row = conn.execute("SELECT pdf_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            conn.execute(
+                "UPDATE jobs SET state = ?, result = ?, lease_expires_at = NULL, updated_at = ? WHERE id = ?",
+                (state, json.dumps(result), time.time(), job_id)
+            )
+        if row is not None and state == JobState.FINISHED:
+            self.remove_spool(row["pdf_path"])
+
+    def resume(self, job_id: str):
+        """Queue a failed job again; its checkpointed pages are reused. Returns False if it cannot be resumed"""
+        with self.connect() as conn:
+            row = conn.execute("SELECT state, pdf_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row["state"] != JobState.FAILED or not os.path.exists(row["pdf_path"]):
+                return False
+            conn.execute(
+                "UPDATE jobs SET state = ?, result = NULL, attempts = 0, worker = NULL, updated_at = ? WHERE id = ? AND state = ?",
+                (JobState.QUEUED, time.time(), job_id, JobState.FAILED)
+            )
+        return True
+
+    def purge(self, state: str, older_than: float):
+        """Drop jobs in the given state, their checkpoints and uploads once they are older than the given number of seconds"""
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT id FROM jobs WHERE state = ? AND updated_at < ?", (state, time.time() - older_than)
+            ).fetchall()
+        for row in rows:
+            self.delete(row["id"])
+
+    def purge_failed(self, older_than: float):
+        self.purge(JobState.FAILED, older_than)
+
+    def purge_finished(self, older_than: float):
+        """Drop finished jobs whose result was never read"""
+        self.purge(JobState.FINISHED, older_than)
+
+    def get(self, job_id: str):
+        """Return {"state": ..., "result": {...}} or None"""
+        with self.connect() as conn:
+            row = conn.execute("SELECT state, result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {"state": row["state"], "result": json.loads(row["result"]) if row["result"] else {}}
+
+    def delete(self, job_id: str):
+        with self.connect() as conn:
+            row = conn.execute("SELECT pdf_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            conn.execute("DELETE FROM job_pages WHERE job_id = ?", (job_id,))
+        if row is not None:
+            self.remove_spool(row["pdf_path"])
+
+    def delete_finished(self, job_id: str):
+        """Drop a finished job once its result was delivered to its webhook; a failed one is kept for /resume"""
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute("DELETE FROM jobs WHERE id = ? AND state = ?", (job_id, JobState.FINISHED)).rowcount:
+                    conn.execute("DELETE FROM job_pages WHERE job_id = ?", (job_id,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def save_page(self, job_id: str, source: str, index: int, first_page: int, last_page: int, total: int, content: str, failed: bool = False):
+        """Record (checkpoint) one finished page ("gpt") or chunk ("document") of a job as soon as it completes"""
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO job_pages (job_id, source, idx, first_page, last_page, total, content, failed, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, source, index, first_page, last_page, total, content, int(failed), time.time())
+            )
+
+    def get_pages(self, job_id: str, after: int = 0):
+        """Pages and chunks recorded after the given rowid, oldest first"""
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT rowid, * FROM job_pages WHERE job_id = ? AND rowid > ? ORDER BY rowid", (job_id, after)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_checkpoint(self, job_id: str):
+        """Successful results of earlier attempts: {"gpt": {page_num: markdown}, "document": {chunk_index: (first, last, markdown)}}"""
+        checkpoint = {"gpt": {}, "document": {}}
+        for row in self.get_pages(job_id):
+            if row["failed"]:
+                continue
+            if row["source"] == "gpt":
+                checkpoint["gpt"][row["idx"]] = row["content"]
+            else:
+                checkpoint["document"][row["idx"]] = (row["first_page"] - 1, row["last_page"] - 1, row["content"])
+        return checkpoint
+
+    @staticmethod
+    def remove_spool(pdf_path: str):
+        try:
+            os.remove(pdf_path)
+        except OSError:
+            pass
+
+def worker_loop(handler, stop_event, worker: str):
+    """Claim and run jobs until stop_event is set; handler(job) returns (state, result)"""
+    queue = JobQueue()
+    print(f"Worker {worker} started")
+
+    last_purge = 0.0
+    while not stop_event.is_set():
+        job = queue.claim(worker)
+        if job is None:
+            if time.time() - last_purge > 60:
+                queue.purge_failed(JOB_FAILED_RETENTION_HOURS * 3600)
+                queue.purge_finished(JOB_FINISHED_RETENTION_HOURS * 3600)
+                last_purge = time.time()
+            stop_event.wait(JOB_POLL_INTERVAL)
+            continue
+
+        print(f"Worker {worker} picked up job {job['id']} (attempt {job['attempts'] + 1})")
+
+        # Keep renewing the lease while the job runs so it is only reclaimed if this process dies
+        done = threading.Event()
+        def heartbeat():
+            while not done.wait(JOB_LEASE_SECONDS / 3):
+                queue.renew_lease(job["id"], worker)
+                metrics.flush()  # Make progress of long jobs visible on /metrics
+        threading.Thread(target=heartbeat, daemon=True).start()
+
+        try:
+            state, result = handler(job)
+        except Exception as e:
+            traceback.print_exc()
+            state, result = JobState.FAILED, {"error": str(e)}
+        finally:
+            done.set()
+
+        queue.complete(job["id"], state, result)
+        metrics.flush()
+        print(f"Worker {worker} finished job {job['id']} ({state})")
+
+def start_workers(handler, count: int = JOB_WORKERS):
+    """Start worker processes and return (processes, stop_event)"""
+    context = multiprocessing.get_context("spawn")
+    stop_event = context.Event()
+    processes = []
+    for i in range(count):
+        # Not daemonic: workers own a process pool for page preprocessing
+        process = context.Process(target=worker_loop, args=(handler, stop_event, f"{os.getpid()}-{i}"), daemon=False)
+        process.start()
+        processes.append(process)
+    return processes, stop_event
+
+def stop_workers(processes, stop_event, timeout: float = 5):
+    """Ask workers to stop; interrupted jobs are picked up again once their lease expires"""
+    stop_event.set()
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            process.terminate()
+            process.join()
@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+import psutil
+from config import *
+
+# Upper bounds (seconds) of every histogram's buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+METRICS = {
+    "pdf2md_stage_seconds": ("histogram", "Time spent in each conversion stage"),
+    "pdf2md_request_seconds": ("histogram", "Latency of requests to each deployment"),
+    "pdf2md_requests_total": ("counter", "Requests to each deployment by outcome"),
+    "pdf2md_tokens_total": ("counter", "Tokens used per deployment by kind"),
+    "pdf2md_retries_total": ("counter", "Retried requests by reason"),
+    "pdf2md_backoff_seconds_total": ("counter", "Time spent sleeping before retries"),
+    "pdf2md_image_encodes_total": ("counter", "Image encode passes while compressing pages"),
+    "pdf2md_pages_total": ("counter", "Converted pages by route"),
+    "pdf2md_cascade_escalations_total": ("counter", "Pages escalated from Document Intelligence to vision GPT by reason"),
+    "pdf2md_webhook_deliveries_total": ("counter", "Webhook delivery attempts by outcome"),
+}
+
+class MetricsRegistry:
+    """Process-wide counters and histograms rendered in the Prometheus text format.
+
+    Worker processes flush snapshots to METRICS_DIR; the API process merges them into /metrics.
+    """
+    def __init__(self, metrics_dir: str = METRICS_DIR):
+        self.metrics_dir = metrics_dir
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                "histograms": [[name, list(labels), list(values)] for (name, labels), values in self.histograms.items()]
+            }
+
+    def flush(self):
+        """Write this process's snapshot for the API process to merge"""
+        path = Path(self.metrics_dir) / f"{os.getpid()}.json"
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = path.with_suffix(".tmp")
+            temp_path.write_text(json.dumps(self.snapshot()))
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Could not write metrics snapshot: {str(e)}")
+
+    def clear_snapshots(self):
+        """Forget snapshots of processes that are gone; those of live processes (e.g. other uvicorn workers) are kept"""
+        for path in Path(self.metrics_dir).glob("*.json"):
+            if path.stem.isdigit() and psutil.pid_exists(int(path.stem)):
+                continue
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def render(self):
+        """Prometheus text exposition of this process merged with every worker snapshot"""
+        snapshots = [self.snapshot()]
+        for path in Path(self.metrics_dir).glob("*.json"):
+            if path.stem == str(os.getpid()):
+                continue
+            try:
+                snapshots.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                pass
+
+        counters = {}
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                merged = histograms.setdefault(key, [0] * len(values))
+                histograms[key] = [a + b for a, b in zip(merged, values)]
+
+        def format_labels(labels, extra=()):
+            pairs = [*labels, *extra]
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+        lines = []
+        for name, (metric_type, description) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+            else:
+                for (metric, labels), values in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(BUCKETS, values):
+                        lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {values[-2]}")
+                    lines.append(f"{name}_count{format_labels(labels)} {values[-2]}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+class StageTimings:
+    """Per-job totals of the time spent in each stage; every observation also feeds the process-wide metrics"""
+    def __init__(self, source: str):
+        self.source = source
+        self.totals = {}  # stage -> [seconds, count]
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self.lock:
+            total = self.totals.setdefault(stage, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+        metrics.observe("pdf2md_stage_seconds", seconds, stage=stage, source=self.source)
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(stage, time.monotonic() - start)
+
+    def summary(self):
+        with self.lock:
+            return {stage: {"seconds": round(seconds, 4), "count": count} for stage, (seconds, count) in self.totals.items()}
+
+# Shared by every job in the process
+metrics = MetricsRegistry()
@@ -1,783 +1,1138 @@
+import asyncio
 import os
 from pathlib import Path
 import base64
-from openai import AzureOpenAI
-from pdf2image import convert_from_bytes
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from pdf2image import convert_from_path, pdfinfo_from_path
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from config import *
+from cache import content_hash, file_hash, make_cache_key, result_cache
+from prompts import FORMAT_BATCH_INSTRUCTIONS, OCR_BATCH_INSTRUCTIONS, OCR_PROMPTS
+from metrics import StageTimings, metrics
+from deployments import di_pool, document_pool, is_transient, ocr_pool
+from rate_limit import (
+    estimate_image_tokens, estimate_text_tokens, is_rate_limited, retry_after_seconds, usage_breakdown, usage_tokens
+)
 from datetime import datetime
 import io
+import json
 import math
+import mmap
+import multiprocessing
+import re
+import threading
 import time
 import psutil
-from PIL import Image, ImageEnhance
+from PIL import Image, ImageEnhance, ImageFilter
 from PyPDF2 import PdfReader, PdfWriter
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject
 from azure.ai.documentintelligence.models import DocumentContentFormat
 
-class ConverterByGPT:
-    def __init__(self, job_id: str):
-        # Initialize Azure OpenAI with key-based authentication
-        self.client = AzureOpenAI(
-            azure_endpoint=OCR_AZURE_OPENAI_ENDPOINT,
-            api_key=OCR_AZURE_OPENAI_KEY,
-            api_version=OCR_AZURE_OPENAI_API_VERSION,
-        )
+class PagePayload:
+    """Encoded page image ready to send, held in memory or spilled to disk under memory pressure"""
+    def __init__(self, page_num: int, image_format: str = None, encoded_image: str = None, spill_path: str = None,
+                 is_blank: bool = False, page_hash: int = None, width: int = None, height: int = None,
+                 timings: dict = None, encodes: int = 0, text: str = None):
+        self.page_num = page_num
+        self.text = text  # Usable text layer of a born-digital page, which is then never rendered
+        self.image_format = image_format
+        self.encoded_image = encoded_image  # base64 string
+        self.spill_path = spill_path
+        self.is_blank = is_blank  # Blank pages carry no image and are never sent
+        self.page_hash = page_hash  # Perceptual hash, only set for pages eligible for duplicate reuse
+        self.width = width  # Dimensions of the encoded image, used to estimate image tokens
+        self.height = height
+        self.timings = timings or {}  # Seconds per preprocessing stage, measured wherever the page was prepared
+        self.encodes = encodes  # Encode passes compression needed
+        self.queued_at = None  # When the page was handed to the API thread pool
+
+    @property
+    def mime_type(self):
+        return f"image/{self.image_format.lower()}"
+
+    def to_base64(self):
+        """Return the base64 payload, reading it back from the spill file if needed"""
+        if self.encoded_image is not None:
+            return self.encoded_image
+        with open(self.spill_path, "rb") as f:
+            return base64.b64encode(f.read()).decode('ascii')
+
+@contextmanager
+def open_pdf(pdf_path: str):
+    """PdfReader over a read-only memory map of the file, so the document is paged in on demand instead of copied"""
+    with open(pdf_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        yield PdfReader(buffer)
+
+_preprocess_pool = None
+_preprocess_pool_lock = threading.Lock()
+
+def get_preprocess_pool():
+    """Return the process pool shared by all jobs for CPU-bound page preprocessing"""
+    global _preprocess_pool
+    with _preprocess_pool_lock:
+        if _preprocess_pool is None:
+            _preprocess_pool = ProcessPoolExecutor(
+                max_workers=PREPROCESS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _preprocess_pool
+
+def reset_preprocess_pool(broken_pool):
+    """Replace a pool that lost a worker process (e.g. to the OOM killer) and return the new one"""
+    global _preprocess_pool
+    with _preprocess_pool_lock:
+        # Jobs sharing the broken pool all get here; only the first one replaces it
+        if _preprocess_pool is broken_pool:
+            broken_pool.shutdown(wait=False, cancel_futures=True)
+            _preprocess_pool = None
+    return get_preprocess_pool()
+
+def iter_preprocessed_window(pdf_path: str, first_page: int, last_page: int, temp_dir: str):
+    """Render a window of pages and yield a PagePayload for each one; born-digital pages carry their text layer instead"""
+    # Classified window by window, so the first requests do not wait for a scan of the whole document
+    start = time.monotonic()
+    text_pages = ConverterByGPT.classify_pages(pdf_path, range(first_page - 1, last_page))
+    classify_seconds = (time.monotonic() - start) / (last_page - first_page + 1)
+    for page_num, text in text_pages.items():
+        yield PagePayload(page_num, text=text, timings={"classify": classify_seconds})
+
+    for run_first, run_last in ConverterByGPT.page_runs(page_num + 1 for page_num in range(first_page - 1, last_page) if page_num not in text_pages):
+        start = time.monotonic()
+        images = convert_from_path(pdf_path, grayscale=True, first_page=run_first, last_page=run_last)
+        render_seconds = (time.monotonic() - start) / max(1, len(images))
+
+        page_num = run_first - 1
+        while images:
+            # Pop each page so only the current window is kept in memory
+            image = images.pop(0)
+            payload = ConverterByGPT.preprocess_image(image, page_num, temp_dir, render_seconds)
+            payload.timings["classify"] = classify_seconds
+            yield payload
+            page_num += 1
+
+def preprocess_window(pdf_path: str, first_page: int, last_page: int, temp_dir: str):
+    """Process pool entry point: render and preprocess a window of pages into ready-to-send payloads"""
+    return list(iter_preprocessed_window(pdf_path, first_page, last_page, temp_dir))
 
+class ConverterByGPT:
+    def __init__(self, job_id: str, on_page=None, checkpoint=None, document_pages=None):
+        self.job_id = job_id
         self.temp_dir = f"{TEMP_DIR}/{job_id}"
-        
-        # Create necessary directories
-        Path(self.temp_dir).mkdir(parents=True, exist_ok=True)
         self.current_date = datetime.now().strftime("%m/%d/%Y")
 
-    def split_pdf_to_images(self, pdf_content: bytes):
-        """Convert PDF pages to PNG images"""
-        images = convert_from_bytes(pdf_content, grayscale=True)
-        image_paths = []
-        
-        for i, image in enumerate(images):
-            image_path = f"{self.temp_dir}/page_{i+1}.png"
-            
-            # Convert to grayscale and enhance contrast
-            if image.mode != 'L':
-                image = image.convert('L')
-            
-            # Enhance contrast
-            enhancer = ImageEnhance.Contrast(image)
-            enhanced_image = enhancer.enhance(2.0)  # Increase contrast by a factor of 2.0
-            
-            # Compress image before saving
-            compressed_image = self.compress_image(enhanced_image)
-            compressed_image.save(image_path, "PNG")
-            
-            # Verify file size
-            file_size_mb = os.path.getsize(image_path) / (1024 * 1024)
-            print(f"Page {i+1} size: {file_size_mb:.2f} MB")
-            
-            if file_size_mb > MAX_IMAGE_SIZE_MB:
-                print(f"Warning: Page {i+1} is still over {MAX_IMAGE_SIZE_MB}, applying emergency compression")
-                with Image.open(image_path) as img:
-                    extra_compressed = self.compress_image(img, target_size_mb=TARGET_IMAGE_SIZE_MB)  # Target slightly below {TARGET_IMAGE_SIZE_MB}
-                    extra_compressed.save(image_path, "PNG")
-                    final_size_mb = os.path.getsize(image_path) / (1024 * 1024)
-                    print(f"Final size after emergency compression: {final_size_mb:.2f} MB")
-            
-            image_paths.append(image_path)
-        
-        return image_paths
-
-    def compress_image(self, image, target_size_mb=MAX_IMAGE_SIZE_MB):
-        """Compress image to target size of {MAX_IMAGE_SIZE_MB} with verification"""
-        def get_size_mb(img):
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='PNG')
-            return len(img_byte_arr.getvalue()) / (1024 * 1024)
-        
-        current_size_mb = get_size_mb(image)
-        if current_size_mb <= target_size_mb:
-            return image
-        
-        # First attempt: JPEG compression
-        quality = 95
-        compressed_image = image
-        while current_size_mb > target_size_mb and quality > 5:
-            img_byte_arr = io.BytesIO()
-            if image.mode in ('RGBA', 'P'):
-                compressed_image = image.convert('RGB')
+        # Per-job report of how each page was processed
+        self.report = {
+            "page_cache_hits": 0, "failed_pages": 0, "prompt_variant": OCR_PROMPT_VARIANT,
+            "api_calls": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "completion_tokens": 0, "api_seconds": 0.0
+        }
+        self.report_lock = threading.Lock()
+        self.timings = StageTimings("gpt")
+
+        # Optional on_page(page_num, markdown, total_pages, failed), called as each page finishes
+        self.on_page = on_page
+        self.failed_page_nums = set()
+
+        # {page_num: markdown} of pages finished by an earlier attempt; only the others are converted
+        self.checkpoint = checkpoint or {}
+
+        # {page_num: markdown} Document Intelligence read well enough in cascade mode; these are used as they are too
+        self.document_pages = document_pages
+
+    def emit_page(self, page_num: int, content: str, total_pages: int):
+        """Hand a finished page to the on_page callback; a failing callback never fails the conversion"""
+        if self.on_page is None:
+            return
+        try:
+            self.on_page(page_num, content, total_pages, page_num in self.failed_page_nums)
+        except Exception as e:
+            print(f"Could not report page {page_num + 1}: {str(e)}")
+
+    def count(self, counter: str, amount: int = 1):
+        """Thread-safe increment of a per-job report counter"""
+        with self.report_lock:
+            self.report[counter] = self.report.get(counter, 0) + amount
+
+    def get_page_count(self, pdf_path: str):
+        """Read the number of pages without rendering any of them"""
+        return pdfinfo_from_path(pdf_path)["Pages"]
+
+    def get_render_windows(self, page_nums):
+        """Group 0-based page numbers into contiguous 1-based (first_page, last_page) rendering windows"""
+        return self.page_runs((page_num + 1 for page_num in page_nums), RENDER_WINDOW_SIZE)
+
+    @staticmethod
+    def page_runs(pages, max_size: int = 0):
+        """Group page numbers into contiguous (first, last) runs of at most max_size pages (0 for no limit)"""
+        runs = []
+        for page in sorted(pages):
+            if runs and runs[-1][1] == page - 1 and (not max_size or runs[-1][1] - runs[-1][0] + 1 < max_size):
+                runs[-1] = (runs[-1][0], page)
             else:
-                compressed_image = image
-            
-            compressed_image.save(img_byte_arr, format='JPEG', quality=quality, optimize=True)
-            current_size_mb = len(img_byte_arr.getvalue()) / (1024 * 1024)
-            quality -= 10  # More aggressive quality reduction
-        
-        # Second attempt: Resize if still too large
-        scale_factor = 1.0
-        while current_size_mb > target_size_mb and scale_factor > 0.1:
-            scale_factor *= 0.7  # More aggressive scaling
-            new_width = int(image.width * scale_factor)
-            new_height = int(image.height * scale_factor)
-            compressed_image = compressed_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            current_size_mb = get_size_mb(compressed_image)
-        
-        # Final verification
-        final_size = get_size_mb(compressed_image)
-        print(f"Final compressed image size: {final_size:.2f} MB")
-        if final_size > target_size_mb:
-            # Emergency compression: force resize to ensure size limit
-            scale_factor = math.sqrt(target_size_mb / final_size) * 0.9  # 10% safety margin
-            new_width = int(image.width * scale_factor)
-            new_height = int(image.height * scale_factor)
-            compressed_image = compressed_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        # Log final compressed size
-        final_size = get_size_mb(compressed_image)
-        print(f"Emergency compression result size: {final_size:.2f} MB")
-        return compressed_image
+                runs.append((page, page))
+        return runs
+
+    @staticmethod
+    def classify_pages(pdf_path: str, page_nums):
+        """Return {page_num: text} for the given pages whose text layer can replace vision OCR"""
+        text_pages = {}
+        if not NATIVE_TEXT_FAST_PATH:
+            return text_pages
+
+        with open_pdf(pdf_path) as reader:
+            for page_num in page_nums:
+                page = reader.pages[page_num]
+                try:
+                    # Form widgets and embedded images carry content the text layer does not
+                    if ConverterByGPT.has_form_widgets(page) or ConverterByGPT.has_images(page.get('/Resources')):
+                        continue
+
+                    text = page.extract_text() or ""
+                    if ConverterByGPT.is_usable_text(text):
+                        text_pages[page_num] = text
+                except Exception as e:
+                    print(f"Could not inspect text layer of page {page_num + 1}: {str(e)}")
+
+        return text_pages
+
+    @staticmethod
+    def has_form_widgets(page):
+        for annotation in page.get('/Annots') or []:
+            if annotation.get_object().get('/Subtype') == '/Widget':
+                return True
+        return False
+
+    @staticmethod
+    def has_images(resources, depth=0):
+        """Look for image XObjects, following nested form XObjects a few levels deep"""
+        if resources is None or depth > 3:
+            return False
+        xobjects = resources.get_object().get('/XObject')
+        if xobjects is None:
+            return False
+        for xobject in xobjects.get_object().values():
+            xobject = xobject.get_object()
+            if xobject.get('/Subtype') == '/Image':
+                return True
+            if xobject.get('/Subtype') == '/Form' and ConverterByGPT.has_images(xobject.get('/Resources'), depth + 1):
+                return True
+        return False
+
+    @staticmethod
+    def is_usable_text(text: str):
+        """A text layer is usable when it is long enough and mostly readable characters"""
+        stripped = text.strip()
+        if len(stripped) < NATIVE_TEXT_MIN_CHARS:
+            return False
+        readable = sum(1 for c in stripped if c.isprintable() or c.isspace())
+        letters = sum(1 for c in stripped if c.isalnum())
+        return readable / len(stripped) >= 0.98 and letters / len(stripped) >= 0.5
+
+    def iter_pdf_images(self, pdf_path: str, page_nums):
+        """Render and preprocess the given pages in small windows and yield a PagePayload as soon as each page is ready"""
+        windows = self.get_render_windows(page_nums)
+
+        if PREPROCESS_WORKERS <= 0:
+            # Preprocess in the calling thread, one page at a time
+            for first_page, last_page in windows:
+                yield from iter_preprocessed_window(pdf_path, first_page, last_page, self.temp_dir)
+            return
+
+        # Fan windows out to the shared process pool, keeping a bounded number in flight
+        pending = {}  # future -> (pool, window)
+        def submit(window):
+            pool = get_preprocess_pool()
+            try:
+                future = pool.submit(preprocess_window, pdf_path, *window, self.temp_dir)
+            except BrokenProcessPool:
+                pool = reset_preprocess_pool(pool)
+                future = pool.submit(preprocess_window, pdf_path, *window, self.temp_dir)
+            pending[future] = (pool, window)
+
+        def result(future):
+            pool, window = pending.pop(future)
+            try:
+                return future.result()
+            except BrokenProcessPool:
+                # A dead worker fails every task on the pool: retry the window once on a new pool
+                print(f"Preprocessing pool broke on pages {window[0]} to {window[1]}, retrying on a new pool")
+                pool = reset_preprocess_pool(pool)
+                return pool.submit(preprocess_window, pdf_path, *window, self.temp_dir).result()
+
+        for window in windows:
+            submit(window)
+            if len(pending) >= PREPROCESS_WORKERS * 2:
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from result(future)
+
+        for future in as_completed(list(pending)):
+            yield from result(future)
+
+    @staticmethod
+    def preprocess_image(image, page_num: int, temp_dir: str, render_seconds: float = 0.0):
+        """Enhance and compress a rendered page into an in-memory PagePayload"""
+        timings = {"render": render_seconds}
+        start = time.monotonic()
+
+        # Convert to grayscale and enhance contrast
+        if image.mode != 'L':
+            image = image.convert('L')
+
+        # Enhance contrast
+        enhancer = ImageEnhance.Contrast(image)
+        enhanced_image = enhancer.enhance(2.0)  # Increase contrast by a factor of 2.0
+
+        # Cheap checks on the grayscale page before paying for compression
+        ink_coverage = ConverterByGPT.ink_coverage(enhanced_image)
+        if SKIP_BLANK_PAGES and ink_coverage <= BLANK_PAGE_MAX_INK:
+            print(f"Page {page_num+1} is blank (ink coverage {ink_coverage:.4%})")
+            timings["enhance"] = time.monotonic() - start
+            return PagePayload(page_num, is_blank=True, timings=timings)
+
+        page_hash = None
+        if DEDUPLICATE_PAGES and ink_coverage <= DUPLICATE_PAGE_MAX_INK:
+            page_hash = ConverterByGPT.page_hash(enhanced_image)
+        timings["enhance"] = time.monotonic() - start
+
+        # Compress image and keep the encoded bytes so the page is never encoded again
+        start = time.monotonic()
+        stats = {}
+        encoded, image_format, (width, height) = ConverterByGPT.compress_image(enhanced_image, stats=stats)
+        timings["compress"] = time.monotonic() - start
+        print(f"Page {page_num+1} size: {len(encoded) / (1024 * 1024):.2f} MB")
+
+        if SPILL_TO_DISK and psutil.virtual_memory().available / (1024 * 1024) < SPILL_MEMORY_THRESHOLD_MB:
+            # Memory is tight: park the encoded bytes in the temp directory until the page is sent
+            Path(temp_dir).mkdir(parents=True, exist_ok=True)
+            spill_path = f"{temp_dir}/page_{page_num+1}.{image_format.lower()}"
+            with open(spill_path, "wb") as f:
+                f.write(encoded)
+            return PagePayload(
+                page_num, image_format, spill_path=spill_path, page_hash=page_hash, width=width, height=height,
+                timings=timings, encodes=stats["encodes"]
+            )
+
+        start = time.monotonic()
+        encoded_image = base64.b64encode(encoded).decode('ascii')
+        timings["base64"] = time.monotonic() - start
+        return PagePayload(
+            page_num, image_format, encoded_image=encoded_image,
+            page_hash=page_hash, width=width, height=height, timings=timings, encodes=stats["encodes"]
+        )
+
+    @staticmethod
+    def ink_coverage(image):
+        """Fraction of dark pixels, ignoring a thin border where scanners leave edge shadows"""
+        margin_x, margin_y = image.width // 30, image.height // 30
+        inner = image.crop((margin_x, margin_y, image.width - margin_x, image.height - margin_y))
+        histogram = inner.histogram()
+        return sum(histogram[:128]) / max(1, inner.width * inner.height)
+
+    @staticmethod
+    def page_hash(image, hash_size: int = 32):
+        """Difference hash of the page's content area, so layout position and scan specks matter little"""
+        # Drop isolated specks before locating the content box
+        despeckled = image.reduce(2).filter(ImageFilter.MaxFilter(3))
+        box = despeckled.point(lambda p: 255 if p < 128 else 0).getbbox()
+        if box:
+            image = image.crop(tuple(v * 2 for v in box))
+
+        pixels = image.resize((hash_size + 1, hash_size), Image.Resampling.BOX).tobytes()
+        bits = 0
+        for y in range(hash_size):
+            row = y * (hash_size + 1)
+            for x in range(hash_size):
+                bits = (bits << 1) | (pixels[row + x] > pixels[row + x + 1])
+        return bits
+
+    @staticmethod
+    def find_duplicate(page_hash: int, seen_hashes):
+        """Return the page number of an earlier page whose hash is within DUPLICATE_PAGE_MAX_DISTANCE"""
+        for seen_hash, seen_page_num in seen_hashes:
+            if bin(page_hash ^ seen_hash).count("1") <= DUPLICATE_PAGE_MAX_DISTANCE:
+                return seen_page_num
+        return None
+
+    @staticmethod
+    def compress_image(image, target_size_mb=MAX_IMAGE_SIZE_MB, stats: dict = None):
+        """Encode image under target_size_mb in as few passes as possible and return (encoded_bytes, image_format, size).
+        The number of encode passes is counted in stats["encodes"] when a dict is given."""
+        target_size = target_size_mb * 1024 * 1024
+        stats = stats if stats is not None else {}
+        stats["encodes"] = 0
+
+        def encode(img, image_format, **params):
+            stats["encodes"] += 1
+            img_byte_arr = io.BytesIO()
+            img.save(img_byte_arr, format=image_format, **params)
+            return img_byte_arr.getvalue()
+
+        # Lossless PNG first: most pages already fit, so this is the only encode
+        encoded = encode(image, 'PNG')
+        if len(encoded) <= target_size:
+            return encoded, 'PNG', image.size
+
+        # Single JPEG pass at a fixed quality instead of stepping down through quality levels
+        if image.mode in ('RGBA', 'P'):
+            image = image.convert('RGB')
+        encoded = encode(image, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+
+        # Encoded size scales with pixel count, so predict the resize from the size ratio
+        # rather than shrinking by a fixed factor. One resize is almost always enough.
+        while len(encoded) > target_size:
+            scale_factor = math.sqrt(target_size / len(encoded)) * 0.95  # 5% safety margin
+            new_width = max(1, int(image.width * scale_factor))
+            new_height = max(1, int(image.height * scale_factor))
+            image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            encoded = encode(image, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+
+        print(f"Final compressed image size: {len(encoded) / (1024 * 1024):.2f} MB")
+        return encoded, 'JPEG', image.size
     
+    def retry_delay(self, error, attempt: int, failovers: int, base_delay: float):
+        """Seconds to wait before retrying after error, or None to fail over to another deployment at once.
+        Raises error when it cannot be retried."""
+        if is_rate_limited(error):
+            wait_time = retry_after_seconds(error) or base_delay * (2 ** attempt)
+            print(f">>>> Rate limit hit. Retrying in {wait_time:.2f} seconds...")
+            metrics.inc("pdf2md_retries_total", pool="ocr", reason="rate_limit")
+            metrics.inc("pdf2md_backoff_seconds_total", wait_time, pool="ocr")
+            return wait_time
+        if is_transient(error) and failovers < ocr_pool.size - 1:
+            print(f">>>> Deployment error: {str(error)}. Failing over...")
+            metrics.inc("pdf2md_retries_total", pool="ocr", reason="failover")
+            return None
+        if is_transient(error):
+            # No other deployment to fail over to: back off and retry this one, as the SDK retries used to
+            wait_time = base_delay * (2 ** attempt)
+            print(f">>>> Deployment error: {str(error)}. Retrying in {wait_time:.2f} seconds...")
+            metrics.inc("pdf2md_retries_total", pool="ocr", reason="transient")
+            metrics.inc("pdf2md_backoff_seconds_total", wait_time, pool="ocr")
+            return wait_time
+        raise error
+
     def retry_with_backoff(self, func, max_retries = RATE_LIMIT_RETRY_MAX_COUNT, base_delay = RATE_LIMIT_RETRY_DELAY):
-        """Retries a function with exponential backoff in case of 429 errors."""
+        """Retries a function on 429 errors, waiting as long as the service asks or backing off exponentially.
+        Transient errors are retried at once on another deployment while the pool has one to offer, then backed off."""
+        failovers = 0
         for attempt in range(max_retries):
             try:
                 return func()
             except Exception as e:
-                if "429" in str(e):
-                    wait_time = base_delay * (2 ** attempt)
-                    print(f">>>> Rate limit hit. Retrying in {wait_time:.2f} seconds...")
+                wait_time = self.retry_delay(e, attempt, failovers, base_delay)
+                if wait_time is None:
+                    failovers += 1
+                    continue
+                with self.timings.time("backoff"):
                     time.sleep(wait_time)
-                else:
-                    raise e
         raise Exception(">>>> Max retries exceeded due to rate limiting.")
 
-    def image_to_markdown(self, image_info):
-        """Convert image to markdown using Azure OpenAI"""
-        image_path, page_num = image_info
+    async def retry_with_backoff_async(self, func, max_retries = RATE_LIMIT_RETRY_MAX_COUNT, base_delay = RATE_LIMIT_RETRY_DELAY):
+        """retry_with_backoff() for coroutine functions; backing off never blocks the event loop"""
+        failovers = 0
+        for attempt in range(max_retries):
+            try:
+                return await func()
+            except Exception as e:
+                wait_time = self.retry_delay(e, attempt, failovers, base_delay)
+                if wait_time is None:
+                    failovers += 1
+                    continue
+                with self.timings.time("backoff"):
+                    await asyncio.sleep(wait_time)
+        raise Exception(">>>> Max retries exceeded due to rate limiting.")
+
+    def record_usage(self, completion, latency: float, deployment: str):
+        """Add one call's prompt, cached and completion tokens to the report and the metrics"""
+        prompt_tokens, cached_tokens, completion_tokens = usage_breakdown(completion)
+        print(f">>>> Usage: {prompt_tokens} prompt ({cached_tokens} cached), {completion_tokens} completion tokens in {latency:.2f}s")
+        metrics.inc("pdf2md_tokens_total", prompt_tokens, deployment=deployment, kind="prompt")
+        metrics.inc("pdf2md_tokens_total", cached_tokens, deployment=deployment, kind="cached")
+        metrics.inc("pdf2md_tokens_total", completion_tokens, deployment=deployment, kind="completion")
+        with self.report_lock:
+            self.report["api_calls"] += 1
+            self.report["prompt_tokens"] += prompt_tokens
+            self.report["cached_prompt_tokens"] += cached_tokens
+            self.report["completion_tokens"] += completion_tokens
+            self.report["api_seconds"] += latency
+
+    def record_call_failed(self, member, error, latency: float):
+        """Feed a failed call back to the metrics and the deployment's concurrency gate"""
+        outcome = "throttled" if is_rate_limited(error) else "error"
+        metrics.observe("pdf2md_request_seconds", latency, pool="ocr", deployment=member.name, outcome=outcome)
+        metrics.inc("pdf2md_requests_total", pool="ocr", deployment=member.name, outcome=outcome)
+        member.concurrency.release(throttled=is_rate_limited(error), retry_after=retry_after_seconds(error))
+
+    def record_call(self, member, ticket, response, latency: float, estimated_tokens: int):
+        """Feed a successful call back to the metrics, the concurrency gate and the rate limiter; returns the completion"""
+        completion = response.parse()
+        self.timings.add("llm", latency)
+        metrics.observe("pdf2md_request_seconds", latency, pool="ocr", deployment=member.name, outcome="ok")
+        metrics.inc("pdf2md_requests_total", pool="ocr", deployment=member.name, outcome="ok")
+
+        # Stop growing once the deployment reports it is about to run out of quota
+        remaining_requests = response.headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = response.headers.get("x-ratelimit-remaining-tokens")
+        near_quota = (remaining_requests is not None and int(remaining_requests) <= 1) or \
+                     (remaining_tokens is not None and int(remaining_tokens) < estimated_tokens)
+        member.concurrency.release(latency=latency, tokens=estimated_tokens, near_quota=near_quota)
+
+        member.limiter.settle(ticket, usage_tokens(completion))
+        self.record_usage(completion, latency, member.name)
+        return completion
+
+    def create_completion(self, estimated_tokens: int, **kwargs):
+        """Chat completion on the least-loaded OCR deployment, admitted through its rate limiter and concurrency gate"""
+        tried = set()
+        def call():
+            with ocr_pool.use(avoid=tried) as member:
+                tried.add(member.name)
+                with self.timings.time("admission_wait"):
+                    ticket = member.limiter.acquire(estimated_tokens, self.job_id)
+                    member.concurrency.acquire()
+                start = time.monotonic()
+                try:
+                    response = member.get_client().chat.completions.with_raw_response.create(model=member.deployment, **kwargs)
+                except Exception as e:
+                    self.record_call_failed(member, e, time.monotonic() - start)
+                    raise
+                return self.record_call(member, ticket, response, time.monotonic() - start, estimated_tokens)
+
+        return self.retry_with_backoff(call)
+
+    async def create_completion_async(self, estimated_tokens: int, **kwargs):
+        """create_completion() on the async engine, sharing the same pools, limiters and concurrency gates"""
+        tried = set()
+        async def call():
+            with ocr_pool.use(avoid=tried) as member:
+                tried.add(member.name)
+                with self.timings.time("admission_wait"):
+                    ticket = await member.limiter.acquire_async(estimated_tokens, self.job_id)
+                    await member.concurrency.acquire_async()
+                start = time.monotonic()
+                try:
+                    response = await member.get_async_client().chat.completions.with_raw_response.create(
+                        model=member.deployment, **kwargs
+                    )
+                except asyncio.CancelledError:
+                    member.concurrency.release()
+                    raise
+                except Exception as e:
+                    self.record_call_failed(member, e, time.monotonic() - start)
+                    raise
+                latency = time.monotonic() - start
+                # Settling a shared rate limiter writes to SQLite
+                return await asyncio.to_thread(self.record_call, member, ticket, response, latency, estimated_tokens)
+
+        return await self.retry_with_backoff_async(call)
+
+    def record_queue_wait(self, payload):
+        """Time a page spent waiting for a free API thread, counted once per page"""
+        if payload.queued_at is not None:
+            self.timings.add("queue_wait", time.monotonic() - payload.queued_at)
+            payload.queued_at = None
+
+    def page_request(self, payload):
+        """Return (cache_key, cached markdown or None, completion arguments) for one page image"""
+        page_num = payload.page_num
+        self.record_queue_wait(payload)
         print(f"Processing page {page_num + 1}...")
-        
-        # Enhanced system prompt focusing on accuracy
-        system_prompt = f"""
-The current date is: {self.current_date}. 
-You are an expert document and form extractor at a law firm. 
-Your job is to meticulously extract all the information from this image.
-
-For every field you extract:
-1. Note if this is filled out in handwritten form or typed
-2. For checkboxes:
-   - Mark [X] ONLY when you are certain the box is checked (contains clear marks, X, or checkmark)
-   - Mark [ ] when the box is clearly empty
-   - If you're unsure about a checkbox status, note "(Status unclear)"
-
-3. For text and numbers:
-   - Extract exactly as they appear, preserving original formatting
-   - If text is unclear, mark as "(Unclear: possible text)"
-   - For empty fields, mark as "[Field is blank]"
-   - For unreadable fields, mark as "(Unreadable)"
-
-4. Form Structure:
-   - Maintain exact form section headers and numbering
-   - Include all field labels exactly as they appear
-   - Preserve the hierarchy of sections
-
-DO NOT:
-- Guess or infer information that isn't clearly visible
-- Mark checkboxes as checked unless you're absolutely certain
-- Modify or "correct" any information - extract exactly as shown
-
-Follow the sample output format provided below.
-
-**Document Name:** Cover Letter
-
-**Extracted Information:**
-
-- **Date:** August 15, 2018 (Typed)
-- **Sender Information:**
-- Name: Maureen Macroscopus (Typed)
-- Address: 1234 Main Street, Los Angeles, CA 90002 (Typed)
-- Phone: (213) 555-1232 (Typed)
-- Email: immigrationlady@abcus.com (Typed)
-
-- **Recipient Information:**
-- USCIS (Typed)
-- P.O. Box 21262 (Typed)
-- Phoenix, AZ 85036 (Typed)
-
-- **Subject:** Form I-90, Application to Replace Permanent Resident Card (Renewal) (Typed)
-- **Applicant:** Serena Janice Williams (Typed)
-- **Alien No:** 210-123-456 (Typed)
-
-- **Filing Fee:**
-- A. Cashier's Check in the amount of $540.00 payable to the U.S. Department of Homeland Security (Typed)
-
-- **Photographs:**
-- B. Two Passport Style Photographs of Applicant (Typed)
-
-- **Forms:**
-- C. I-90, Application to Replace Permanent Resident Card (Typed)
-
-- **Identity and Proof of Citizenship/Nationality Documents:**
-- D. Copy of Applicant's American Passport (Typed)
-- E. Copy of Front and Back of Applicant's LPR Card (Typed)
-
-- **Signature:** Signature present (Handwritten)
-
-**Instructions:**
-- The letter is a cover letter for the application packet for replacing a Permanent Resident Card.
-- It lists the documents and items included in the application packet.
-- It instructs not to contact the applicant with any questions or concerns.
----
-**Document Name:** Exhibit A
-
-This page is a cover page titled "EXHIBIT - A". There is no additional information, fields, or instructions to extract from this page.
----
-**Document Name:** Filing Fees Instructions
-
-Instructions Extracted:
-1. Filing Fees
-2. Remember to:
-- Use a Cashier's Check, Money Order, or Personal Check.
-- Make it payable to: US Department of Homeland Security.
-- Include Name and A# in the Memo Line.
-
-No fields to fill out on this page.
----
-Document Name: Exhibit B
-
-Information Extracted:
-- Title: EXHIBIT - B
-
-Note: This page appears to be a cover page or a divider for Exhibit B. No fields to fill out or instructions are present on this page.
----
-Document Name: Passport Style Photo Instructions
-
-Instructions Extracted:
-1. Label Each Photo with full name and A#.
-2. Photos should be 2 x 2.
-3. Photos MUST have white background.
-4. Label the Envelope.
-
-No fields to fill out on this page.
----
-Document Name: Exhibit C
-
-Information Extracted:
-- The page is a cover page for Exhibit C.
-- No fields to fill out or instructions are present on this page.
-- No signature field is present.
----
-**Document Name:** Application to Replace Permanent Resident Card (Form I-90)
-**Page Number:** 1 of 7
-
-### Extracted Information:
-
-#### Part 1. Information About You
-1. **Alien Registration Number (A-Number):** A 0 9 8 7 6 5 4 3 2 (Handwritten)
-2. **USCIS Online Account Number (if any):** [Field is blank]
-3. **Your Full Name:**
-- **Family Name (Last Name):** WILLIAMS (Typed)
-- **Given Name (First Name):** ANDREA (Typed)
-- **Middle Name:** JAMES (Typed)
-
-4. **Has your name legally changed since the issuance of your Permanent Resident Card?**
-- [ ] Yes (Proceed to Item Numbers 5.a. - 5.c.)
-- [x] No (Proceed to Item Numbers 6.a. - 6.c.) (Typed)
-- [ ] Yes, I am a commuter and my name has legally changed since the issuance of my Permanent Resident Card. (Proceed to Item Numbers 5.a. - 5.c.)
-
-5. **Provide your name exactly as it is printed on your current Permanent Resident Card:**
-- **Family Name (Last Name):** [Field is blank]
-- **Given Name (First Name):** [Field is blank]
-- **Middle Name:** [Field is blank]
-
-#### Mailing Address
-6.a. **In Care Of Name:** [Field is blank]
-6.b. **Street Number and Name:** 1234 PALMER STREET (Typed)
-- [x] Apt. [ ] Ste. [ ] Flr.
-6.c. **City or Town:** ENGLEWOOD (Typed)
-6.d. **State:** CA (Typed)
-6.e. **ZIP Code:** 90210 (Typed)
-6.f. **Province:** [Field is blank]
-6.g. **Postal Code:** [Field is blank]
-6.h. **Country:** USA (Typed)
-
-#### Physical Address
-(Provide this information only if different from mailing address.)
-7.a. **Street Number and Name:** SAME AS ABOVE (Typed)
-- [ ] Apt. [ ] Ste. [ ] Flr.
-7.b. **City or Town:** [Field is blank]
-7.c. **State:** [Field is blank]
-7.d. **ZIP Code:** [Field is blank]
-7.e. **Province:** [Field is blank]
-7.f. **Postal Code:** [Field is blank]
-7.g. **Country:** [Field is blank]
-
-### Instructions:
-- **Type or print in black ink.**
-- **If your name has legally changed since the issuance of your Permanent Resident Card, proceed to Item Numbers 5.a. - 5.c.**
-- **If your name has not legally changed, proceed to Item Numbers 6.a. - 6.c.**
-- **Provide your name exactly as it is printed on your current Permanent Resident Card.**
-- **Provide physical address only if different from mailing address.**
-
-### Signature:
-- No signature field is present on this page.
----
-**Document Name:** Form I-90
-**Page Number:** 2 of 7
-
-### Extracted Information:
-
-#### Part 1. Information About You (continued)
-
-- **Gender:** Female (Typed)
-- **Date of Birth (mm/dd/yyyy):** 04/15/2000 (Typed)
-- **City/Town/Village of Birth:** HARTFORD (Typed)
-- **Country of Birth:** AMERICA (Typed)
-
-- **Mother's Name:**
-- **Given Name (First Name):** JANE (Typed)
-- **Family Name (Last Name):** DOE (Typed)
-
-- **Father's Name:**
-- **Given Name (First Name):** JOHN (Typed)
-- **Family Name (Last Name):** DOE (Typed)
-
-- **Class of Admission:** (Not filled)
-- **Date of Admission (mm/dd/yyyy):** 06/15/2005 (Typed)
-- **U.S. Social Security Number (if any):** 123-45-6789 (Typed)
-
-#### Part 2. Application Type
-
-- **My status is (Select only one box):**
-- [ ] Lawful Permanent Resident (Proceed to Section A.)
-- [X] Permanent Resident - In Commuter Status (Proceed to Section B.) (Typed)
-- [ ] Conditional Permanent Resident (Proceed to Section C.)
-
-### Instructions:
-
-- **Reasons for Application (Select only one box):**
-- Section A: (To be used only by a lawful permanent resident or a permanent resident in commuter status.)
-- [ ] My previous card has been lost, stolen, or destroyed.
-- [ ] My previous card was issued but never received.
-- [ ] My existing card has been mutilated.
-- [ ] My existing card has incorrect data because of Department of Homeland Security (DHS) error. (Attach your existing card with incorrect data along with this application.)
-- [ ] My name or other biographic information has been legally changed since issuance of my existing card.
-- [X] My existing card has already expired or will expire within six months. (Typed)
-- [ ] I have reached my 14th birthday and am registering as required. My existing card will expire after my 16th birthday. (See Note below for additional information.)
-- [ ] I have reached my 14th birthday and am registering as required. My existing card will expire before my 16th birthday. (See Note below for additional information.)
-- **NOTE:** If you are filing this application before your 14th birthday, or more than 30 days after your 14th birthday, you must select reason 2.a. Otherwise, if your card has expired, you must select reason 2.f.
-- Section B:
-- [ ] I am a permanent resident who is taking up commuter status.
-- [ ] My Port-of-Entry (POE) into the United States will be (City or Town and State): __________
-- [ ] I am a commuter who is taking up actual residence in the United States.
-- Section C:
-- [ ] I have been automatically converted to lawful permanent resident status.
-- [ ] I have a prior edition of the Alien Registration Card, or am applying to replace my current Permanent Resident Card for a reason that is not specified above.
----
-**Document Name:** Form I-90
-**Page Number:** 1 of 7
-
-### Extracted Information:
-
-#### Part 1. Application Type (continued)
-- **Section B (To be used only by a conditional permanent resident):**
-- **1.a.** My previous card has been lost, stolen, or destroyed. [ ]
-- **1.b.** My previous card was issued but never received. [ ]
-- **1.c.** My existing card has been mutilated. [ ]
-- **1.d.** My existing card has incorrect data because of DHS error. (Attach your existing permanent resident card with incorrect data along with this application.) [ ]
-- **1.e.** My name or other biographic information has legally changed since the issuance of my existing card. [ ]
-
-#### Part 3. Processing Information
-- **1. Location where you applied for an immigrant visa or adjustment of status:**
-- **Location:** [Handwritten/Typed]
-- **2. Location where your immigrant visa was issued or USCIS office where you were granted adjustment of status:**
-- **Location:** [Handwritten/Typed]
-- **3. Destination in the United States at time of admission:**
-- **Destination:** [Handwritten/Typed]
-- **4. Port of Entry where admitted to the United States (City or Town and State):**
-- **Port of Entry:** [Handwritten/Typed]
-- **5.a.** Have you ever been in exclusion, deportation, or removal proceedings or ordered removed from the United States?
-- [ ] Yes
-- [ ] No
-- **5.b.** Have you ever been granted permanent residence, had your card filed in 1-407, abandonment by Office of Return or United States Consulate, or otherwise been determined to have abandoned your status?
-- [ ] Yes
-- [ ] No
-
-#### Part 4. Accommodations for Individuals with Disabilities and/or Impairments
-- **1.** Are you requesting an accommodation because of your disabilities and/or impairments?
-- [ ] Yes
-- [ ] No
-- **2.a.** I am deaf or hard of hearing and request the following accommodation (if you are requesting a sign language interpreter, indicate for which language):
-- [Handwritten/Typed]
-
-### Biographic Information
-- **1. Ethnicity (Select only one box):**
-- [ ] Hispanic or Latino
-- [ ] Not Hispanic or Latino
-- **2. Race (Select all applicable boxes):**
-- [ ] White
-- [ ] Asian
-- [ ] Black or African American
-- [ ] American Indian or Alaska Native
-- [ ] Native Hawaiian or Other Pacific Islander
-- **3. Height:**
-- **Feet:** [Handwritten/Typed]
-- **Inches:** [Handwritten/Typed]
-- **4. Weight:**
-- **Pounds:** [Handwritten/Typed]
-- **5. Eye Color (Select only one box):**
-- [ ] Black
-- [ ] Blue
-- [ ] Brown
-- [ ] Gray
-- [ ] Green
-- [ ] Hazel
-- [ ] Maroon
-- [ ] Pink
-- [ ] Unknown/Other
-- **6. Hair Color (Select only one box):**
-- [ ] Bald (No hair)
-- [ ] Black
-- [ ] Blond
-- [ ] Brown
-- [ ] Gray
-- [ ] Red
-- [ ] Sandy
-- [ ] White
-- [ ] Unknown/Other
-
-### Instructions:
-- **Part 4. Accommodations for Individuals with Disabilities and/or Impairments:**
-- Read the information in the Form I-90 Instructions before completing this part.
-- If you need extra space to complete this section, use the space provided in Part 8. Additional Information.
-- If you answered "Yes," select any applicable boxes.
-
-### Signature:
-- No signature field or placeholder is present on this page.
----
-**Document Name:** Form I-912
-
-### Extracted Information:
-
-#### Part 4. Accommodations for Individuals with Disabilities and/or Impairments (continued)
-- **5.a.** [ ] I am blind or have low vision and request the following accommodation:
-- **Accommodation Details:** (Handwritten/Typed: Not filled)
-
-- **5.b.** [ ] I have another type of disability and/or impairment (Describe the nature of your disability and/or impairment and the accommodation you are requesting):
-- **Description and Accommodation:** (Handwritten/Typed: Not filled)
-
-#### Applicant's Contact Information
-- **3. Applicant's Daytime Telephone Number:** (Handwritten/Typed: Not filled)
-- **4. Applicant's Mobile Telephone Number (if any):** (Handwritten/Typed: Not filled)
-- **5. Applicant's Email Address (if any):** (Handwritten/Typed: Not filled)
-
-#### Applicant's Certification
-- **Certification Text:**
-- Copies of any documents I have submitted are exact photocopies of unaltered, original documents, and I understand that USCIS may require that I submit original documents at a later date. Furthermore, I authorize the release of any information from my records that USCIS may need to determine my eligibility for the benefit I seek.
-- I further authorize release of information contained in this application, in supporting documents, and in USCIS records to other entities and persons where necessary for the administration and enforcement of U.S. immigration law.
-- I understand that USCIS will require me to appear for an appointment to take my biometrics (fingerprints, photograph, and/or signature) and, at that time, I will be required to sign an oath reaffirming that:
-1. I reviewed and provided or authorized all of the information in my application,
-2. I understood all of the information contained in, and submitted with, my application, and
-3. All of this information was complete, true, and correct at the time of filing.
-- I certify, under penalty of perjury, that I provided or authorized all of the information in my application, I understood all of the information contained in, and submitted with, my application, and that all of this information is complete, true, and correct.
-
-#### Applicant's Statement
-- **NOTE:** Select the box for either Item Number 1.a. or 1.b. If applicable, select the box for Item Number 2.
-- **1.a.** [ ] I can read and understand English, and I have read and understand every question and instruction on this application and my answer to every question.
-- **1.b.** [ ] The interpreter named in Part 6. read to me every question and instruction on this application and my answer to every question in a language in which I am fluent and I understood everything.
-- **Language:** (Handwritten/Typed: Not filled)
-- **2.** [ ] At my request, the preparer named in Part 7., (Handwritten/Typed: Not filled), prepared this application for me based only upon information I provided or authorized.
-
-#### Applicant's Signature
-- **6.a. Applicant's Signature:** Signature present
-- **6.b. Date of Signature (mm/dd/yyyy):** (Handwritten/Typed: Not filled)
-
-#### Instructions:
-- **NOTE TO ALL APPLICANTS:** If you do not complete 6.a. on this application or 6.b. or select required boxes as listed in the instructions, USCIS may deny your application.
----
-**Document Name:** Form I-485
-**Page Number:** 7 of 7
-
-### Extracted Information:
-
-#### Part 6. Interpreter's Contact Information, Certification, and Signature
-
-- **Interpreter's Full Name:**
-- 1.a. Interpreter's Family Name (Last Name): [Not filled]
-- 1.b. Interpreter's Given Name (First Name): [Not filled]
-- 1.c. Interpreter's Business or Organization Name: [Not filled]
-
-- **Interpreter's Mailing Address:**
-- 2.a. Street Number and Name: [Not filled]
-- 2.b. Apt. Ste. Flr.: [Not filled]
-- 2.c. City or Town: [Not filled]
-- 2.d. State: [Not filled]
-- 2.e. ZIP Code: [Not filled]
-- 2.f. Province: [Not filled]
-- 2.g. Postal Code: [Not filled]
-- 2.h. Country: [Not filled]
-
-- **Interpreter's Contact Information:**
-- 3. Interpreter's Daytime Telephone Number: [Not filled]
-- 4. Interpreter's Mobile Telephone Number (if any): [Not filled]
-- 5. Interpreter's Email Address (if any): [Not filled]
-
-- **Interpreter's Certification:**
-- I certify, under penalty of perjury, that: [Not filled]
-- I am fluent in English and [Not filled] which is the same language provided in Part 5., Item Number 1.b., and I have read to this applicant in the identified language every question and instruction on this application and his or her answer to every question. The applicant informed me that he or she understands every instruction, question, and answer on the application, including the Applicant's Certification, and has verified the accuracy of every answer. [Not filled]
-
-- **Interpreter's Signature:**
-- 6.a. Interpreter's Signature (sign in ink): [Not filled]
-- 6.b. Date of Signature (mm/dd/yyyy): [Not filled]
-
-#### Part 7. Contact Information, Declaration, and Signature of the Person Preparing this Application, if Other Than the Applicant
-
-- **Preparer's Full Name:**
-- 1.a. Preparer's Family Name (Last Name): SMITH (typed)
-- 1.b. Preparer's Given Name (First Name): JOHN (typed)
-- 1.c. Preparer's Business or Organization Name: [Not filled]
-
-- **Preparer's Mailing Address:**
-- 2.a. Street Number and Name: 1234 MAIN STREET (typed)
-- 2.b. Apt. Ste. Flr.: [Not filled]
-- 2.c. City or Town: SAN ANTONIO (typed)
-- 2.d. State: TX (typed)
-- 2.e. ZIP Code: 78201 (typed)
-- 2.f. Province: [Not filled]
-- 2.g. Postal Code: [Not filled]
-- 2.h. Country: USA (typed)
-
-- **Preparer's Contact Information:**
-- 3. Preparer's Daytime Telephone Number: (210)555-1234 (typed)
-- 4. Preparer's Mobile Telephone Number (if any): [Not filled]
-- 5. Preparer's Email Address (if any): JOHN.SMITH@EMAIL.COM (typed)
-
-### Instructions:
-
-- Provide the following information about the interpreter.
-- Provide the following information about the preparer.
-- The interpreter must sign and date the form in ink.
-- The preparer must provide their full name, mailing address, and contact information.
-- The preparer must sign and date the form if they are not the applicant.
-
-### Signature Fields:
-
-- Interpreter's Signature: Not present
-- Preparer's Signature: Not present
----
-Document Name: Form I-485 Supplement J
-Page Number: 4 of 7
-
-**Extracted Information:**
-
-**Preparer's Statement:**
-- **1.a.** Checkbox selected: "I am not an attorney or accredited representative but have prepared this application on behalf of the applicant and with the applicant's consent." (Typed)
-
-**Preparer's Certification:**
-- The preparer certifies under penalty of perjury that they have reviewed the completed petition and that the information is complete, true, and correct. (Typed)
-
-**Preparer's Signature:**
-- **8.a.** Preparer's Signature: Signature present (Handwritten)
-- **8.b.** Date of Signature: 12/15/2024 (Handwritten)
-
-**Instructions:**
-- If you are an attorney or accredited representative whose representation extends beyond preparation of this application, you may be obliged to submit a completed Form G-28, Notice of Entry of Appearance as Attorney or Accredited Representative, with this application.
----
-**Document Name:** Form I-485 Supplement A
-
-**Extracted Information:**
-
-- **Part 8. Additional Information:**
-- **Instructions:**
-- If you need extra space to provide any additional information within this application, use the space below.
-- If you need more space than what is provided, you may make copies of this page to complete and file with this application or attach a separate sheet of paper.
-- Include your name and A-Number (if any) at the top of each sheet; indicate the Page Number, Part Number, and Item Number to which your answer refers, and sign and date each sheet.
-
-- **Your Full Name:**
-- **Family Name (Last Name):** MCCLAMROCK (Typed)
-- **Given Name (First Name):** JAMES (Typed)
-- **Middle Name:** ANDREW (Typed)
-- **A-Number (if any):** A 0 0 0 0 0 0 0 0 0 (Typed)
-
-- **Additional Information Sections:**
-- **Page Number, Part Number, Item Number:** Multiple fields provided for additional information, all are blank.
-
-**Signature Field:** No signature field is present on this page.
----
-Document Name: Exhibit D
-
-
-Information Extracted:
-- The page contains only the text "EXHIBIT - D" which is typed.
-- No other information or instructions are present on this page.
-- No signature field or placeholder is present.
----
-Document Name: Passport Copy
-
-Extracted Information:
-- Document Type: Passport
-- Country: Jamaica
-- Passport Number: Not visible
-- Personal Information: Not visible
-- Photograph: Present
-- Signature: Not applicable (no signature field visible)
-
-Instructions:
-- "Copy of Biometrics Page of Passport"
-- "Copy in Color to ensure that it is a quality copy"
-
-Note: The information on the passport is not clearly visible in the image provided.
----
-Document Name: Exhibit E
-
-- This page is a cover page for Exhibit E.
-- No information is filled out on this page.
-- No instructions or signature fields are present.
----
-Document Name: Copy of Front and Back of Green Card
-
-Extracted Information:
-- Document Type: United States of America Permanent Resident Card
-- Name: Specimen
-- Given Name: Test V
-- USCIS Number: 000-000-000
-- Country of Birth: Democratic Republic of Congo
-- Category: IR1
-- Resident Since: 08/16/11
-- Card Expires: 08/16/21
-
-Instructions:
-- "Copy of Front and Back of Green Card"
-- "(Copy in Color to ensure that it is a quality copy)"
-
-Note: The information appears to be typed. There is no signature field or placeholder on this page.
 
-"""
+        # Static system prompt first so it is served from the provider's prompt cache
+        system_prompt = OCR_PROMPTS[OCR_PROMPT_VARIANT]
 
-        try:
-            # Convert image directly to bytes for API
-            with Image.open(image_path) as image:
-                img_byte_arr = io.BytesIO()
-                image.save(img_byte_arr, format='PNG')
-                img_byte_arr = img_byte_arr.getvalue()
-                
-                # Convert to base64
-                encoded_image = base64.b64encode(img_byte_arr).decode('ascii')
-
-            # Prepare chat prompt
-            chat_prompt = [
-                {
-                    "role": "system",
-                    "content": [{"type": "text", "text": system_prompt}]
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "\n"},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{encoded_image}"
-                            }
-                        },
-                        {
-                            "type": "text", 
-                            "text": "Please extract all information from this image, being especially careful with checkboxes and form fields. If you're unsure about any information, indicate that clearly."
+        if payload.spill_path:
+            with self.timings.time("base64"):
+                encoded_image = payload.to_base64()
+        else:
+            encoded_image = payload.to_base64()
+
+        # Identical page renders are served from the cache without a network call
+        cache_key = make_cache_key("page", content_hash(encoded_image), ocr_pool.model_key, OCR_PROMPT_VARIANT)
+        cached_content = result_cache.get(cache_key)
+        if cached_content is not None:
+            print(f"Page {page_num + 1} served from cache")
+            self.count("page_cache_hits")
+            return cache_key, cached_content, None
+
+        # Prepare chat prompt
+        chat_prompt = [
+            {
+                "role": "system",
+                "content": [{"type": "text", "text": system_prompt}]
+            },
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "\n"},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{payload.mime_type};base64,{encoded_image}"
                         }
-                    ]
-                }
-            ]
+                    },
+                    {
+                        "type": "text",
+                        "text": "Please extract all information from this image, being especially careful with checkboxes and form fields. If you're unsure about any information, indicate that clearly."
+                    },
+                    # Volatile details last so they never break the cached prefix
+                    {"type": "text", "text": f"The current date is: {self.current_date}."}
+                ]
+            }
+        ]
+
+        # Get completion with optimized parameters
+        estimated_tokens = (
+            estimate_text_tokens(system_prompt)
+            + estimate_image_tokens(payload.width, payload.height)
+            + ESTIMATED_COMPLETION_TOKENS
+        )
+        return cache_key, None, {
+            "estimated_tokens": estimated_tokens,
+            "messages": chat_prompt,
+            "temperature": 0.0,  # Maximum consistency
+            "top_p": 0.90,      # Slightly increased for better accuracy
+            "frequency_penalty": 0,
+            "presence_penalty": 0,
+            "stop": None,
+            "stream": False
+        }
+
+    def page_completed(self, page_num: int, cache_key: str, completion):
+        print(f"Processing page {page_num + 1} successfully completed!")
+        content = completion.choices[0].message.content
+        result_cache.set(cache_key, content)
+        return page_num, content
+
+    def page_failed(self, page_num: int, error):
+        print(f"Error processing page {page_num + 1}: {str(error)}")
+        self.count("failed_pages")
+        self.failed_page_nums.add(page_num)
+        # return page_num, f"Error processing page: {str(error)}"
+        return page_num, f"Can't process this page for some reason. It might be due to the violation of the terms of Azure OpenAI service."
+
+    def image_to_markdown(self, payload):
+        """Convert image to markdown using Azure OpenAI"""
+        try:
+            cache_key, cached_content, request = self.page_request(payload)
+            if cached_content is not None:
+                return payload.page_num, cached_content
+            return self.page_completed(payload.page_num, cache_key, self.create_completion(**request))
+        except Exception as e:
+            return self.page_failed(payload.page_num, e)
 
-            # Get completion with optimized parameters
-            completion = self.retry_with_backoff(lambda: self.client.chat.completions.create(
-                model=OCR_AZURE_DEPLOYMENT_NAME,
-                messages=chat_prompt,
-                temperature=0.0,  # Maximum consistency
-                top_p=0.90,      # Slightly increased for better accuracy
-                frequency_penalty=0,
-                presence_penalty=0,
-                stop=None,
-                stream=False
-            ))
+    async def image_to_markdown_async(self, payload):
+        """image_to_markdown() on the async engine; cache reads and writes run in a thread, off the event loop"""
+        try:
+            cache_key, cached_content, request = await asyncio.to_thread(self.page_request, payload)
+            if cached_content is not None:
+                return payload.page_num, cached_content
+            completion = await self.create_completion_async(**request)
+            return await asyncio.to_thread(self.page_completed, payload.page_num, cache_key, completion)
+        except Exception as e:
+            return self.page_failed(payload.page_num, e)
+
+    def batch_request(self, payloads):
+        """Split a batch into cached results and pages still to convert, with the completion arguments for those pages.
+        Returns (results, pages, request); request is None when fewer than two pages are left."""
+        pages = []
+        results = []
+        for payload in payloads:
+            self.record_queue_wait(payload)
+            encoded_image = payload.to_base64()
+            cache_key = make_cache_key("page", content_hash(encoded_image), ocr_pool.model_key, OCR_PROMPT_VARIANT)
+            cached_content = result_cache.get(cache_key)
+            if cached_content is not None:
+                self.count("page_cache_hits")
+                results.append((payload.page_num, cached_content))
+            else:
+                pages.append((payload, encoded_image, cache_key))
+
+        if len(pages) < 2:
+            return results, pages, None
+
+        print(f"Processing pages {self.batch_labels(pages)} in one request...")
+
+        system_prompt = OCR_PROMPTS[OCR_PROMPT_VARIANT]
+        content = []
+        for payload, encoded_image, _ in pages:
+            content.append({"type": "text", "text": f"Page {payload.page_num + 1}:"})
+            content.append({"type": "image_url", "image_url": {"url": f"data:{payload.mime_type};base64,{encoded_image}"}})
+        content.append({"type": "text", "text": OCR_BATCH_INSTRUCTIONS.format(count=len(pages))})
+        content.append({"type": "text", "text": f"The current date is: {self.current_date}."})
+
+        estimated_tokens = (
+            estimate_text_tokens(system_prompt)
+            + sum(estimate_image_tokens(payload.width, payload.height) for payload, _, _ in pages)
+            + ESTIMATED_COMPLETION_TOKENS * len(pages)
+        )
+        return results, pages, {
+            "estimated_tokens": estimated_tokens,
+            "messages": [
+                {"role": "system", "content": [{"type": "text", "text": system_prompt}]},
+                {"role": "user", "content": content}
+            ],
+            "temperature": 0.0,
+            "top_p": 0.90,
+            "frequency_penalty": 0,
+            "presence_penalty": 0,
+            "stop": None,
+            "stream": False
+        }
+
+    @staticmethod
+    def batch_labels(pages):
+        return ", ".join(str(payload.page_num + 1) for payload, _, _ in pages)
+
+    def batch_completed(self, pages, sections):
+        """Record a batch's pages if every one came back exactly once with some content; False when it must be redone page by page"""
+        page_labels = self.batch_labels(pages)
+        if sorted(sections) != sorted(payload.page_num for payload, _, _ in pages) or not all(sections.values()):
+            print(f">>>> Batch of pages {page_labels} could not be split; falling back to single pages")
+            self.count("batch_fallback_pages", len(pages))
+            return False
+
+        self.count("batch_requests")
+        self.count("batched_pages", len(pages))
+        # One system prompt was sent instead of one per page
+        self.count("estimated_prompt_tokens_saved", estimate_text_tokens(OCR_PROMPTS[OCR_PROMPT_VARIANT]) * (len(pages) - 1))
+        for payload, _, cache_key in pages:
+            result_cache.set(cache_key, sections[payload.page_num])
+        print(f"Processing pages {page_labels} successfully completed!")
+        return True
+
+    def images_to_markdown(self, payloads):
+        """Convert several page images in one request; returns [(page_num, markdown)], falling back to single pages"""
+        results, pages, request = self.batch_request(payloads)
+        if request is not None:
+            try:
+                completion = self.create_completion(**request)
+                sections = self.split_batch_output(completion.choices[0].message.content or "")
+            except Exception as e:
+                print(f"Error processing pages {self.batch_labels(pages)}: {str(e)}")
+                sections = {}
+            if self.batch_completed(pages, sections):
+                return results + [(payload.page_num, sections[payload.page_num]) for payload, _, _ in pages]
 
-            print(f"Processing page {page_num + 1} successfully completed!")
+        return results + [self.image_to_markdown(payload) for payload, _, _ in pages]
 
-            return page_num, completion.choices[0].message.content
+    async def images_to_markdown_async(self, payloads):
+        """images_to_markdown() on the async engine; fallback pages are converted concurrently"""
+        results, pages, request = await asyncio.to_thread(self.batch_request, payloads)
+        if request is not None:
+            try:
+                completion = await self.create_completion_async(**request)
+                sections = self.split_batch_output(completion.choices[0].message.content or "")
+            except Exception as e:
+                print(f"Error processing pages {self.batch_labels(pages)}: {str(e)}")
+                sections = {}
+            if await asyncio.to_thread(self.batch_completed, pages, sections):
+                return results + [(payload.page_num, sections[payload.page_num]) for payload, _, _ in pages]
+
+        return results + list(await asyncio.gather(*(self.image_to_markdown_async(payload) for payload, _, _ in pages)))
+
+    @staticmethod
+    def split_batch_output(output: str):
+        """Split a batched answer on its <<<PAGE n>>> delimiters into {page_num: markdown}; empty if it cannot be attributed"""
+        parts = re.split(r"^[ \t]*<<<PAGE (\d+)>>>[ \t]*$", output, flags=re.MULTILINE)
+        if parts[0].strip():
+            return {}  # Text before the first delimiter cannot be attributed to a page
+
+        sections = {}
+        for label, section in zip(parts[1::2], parts[2::2]):
+            page_num = int(label) - 1
+            if page_num in sections:
+                return {}
+            sections[page_num] = section.strip()
+        return sections
+
+    def convert_pages(self, pages):
+        """Convert pages handed out by route_page(), in one request when batching is on"""
+        if pages[0].text is not None:
+            return [self.text_to_markdown(pages[0].page_num, pages[0].text)]
+        if VISION_BATCH_SIZE <= 1:
+            return [self.image_to_markdown(pages[0])]
+        return self.images_to_markdown(pages)
+
+    async def convert_pages_async(self, pages):
+        if pages[0].text is not None:
+            return [await self.text_to_markdown_async(pages[0].page_num, pages[0].text)]
+        if VISION_BATCH_SIZE <= 1:
+            return [await self.image_to_markdown_async(pages[0])]
+        return await self.images_to_markdown_async(pages)
+
+    def text_request(self, page_num: int, text: str):
+        """Return (cache_key, cached markdown or None, completion arguments) for structuring a page's text layer"""
+        cache_key = make_cache_key("text", content_hash(text), ocr_pool.model_key)
+        cached_content = result_cache.get(cache_key)
+        if cached_content is not None:
+            self.count("page_cache_hits")
+            return cache_key, cached_content, None
+
+        print(f"Structuring text of page {page_num + 1}...")
+        system_prompt = """
+You are an expert document and form extractor at a law firm.
+You are given the text layer of one typed PDF page. Reformat it into markdown without adding, removing or correcting any information.
+Start with "**Document Name:**" followed by the document title, then "**Extracted Information:**" with the content as bullet points,
+and list any instructions under "**Instructions:**". Preserve section headers, numbering and field labels exactly. All text is typed.
+"""
+        return cache_key, None, {
+            "estimated_tokens": estimate_text_tokens(system_prompt + text) + ESTIMATED_COMPLETION_TOKENS,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": text}
+            ],
+            "temperature": 0.0,
+            "stop": None,
+            "stream": False
+        }
+
+    def text_to_markdown(self, page_num: int, text: str):
+        """Convert a page's native text layer to markdown, skipping vision OCR"""
+        if not NATIVE_TEXT_LLM_FORMAT:
+            return page_num, text.strip()
+
+        cache_key, cached_content, request = self.text_request(page_num, text)
+        if cached_content is not None:
+            return page_num, cached_content
+
+        try:
+            completion = self.create_completion(**request)
+            content = completion.choices[0].message.content
+            result_cache.set(cache_key, content)
+            return page_num, content
+        except Exception as e:
+            print(f"Error structuring text of page {page_num + 1}: {str(e)}")
+            return page_num, text.strip()
+
+    async def text_to_markdown_async(self, page_num: int, text: str):
+        """text_to_markdown() on the async engine"""
+        if not NATIVE_TEXT_LLM_FORMAT:
+            return page_num, text.strip()
+
+        cache_key, cached_content, request = await asyncio.to_thread(self.text_request, page_num, text)
+        if cached_content is not None:
+            return page_num, cached_content
 
+        try:
+            completion = await self.create_completion_async(**request)
+            content = completion.choices[0].message.content
+            await asyncio.to_thread(result_cache.set, cache_key, content)
+            return page_num, content
         except Exception as e:
-            print(f"Error processing page {page_num + 1}: {str(e)}")
-            # return page_num, f"Error processing page: {str(e)}"
-            return page_num, f"Can't process this page for some reason. It might be due to the violation of the terms of Azure OpenAI service."
+            print(f"Error structuring text of page {page_num + 1}: {str(e)}")
+            return page_num, text.strip()
 
     def combine_markdown_files(self, markdown_contents):
         """Combine all markdown content into a single string"""
         combined_content = ""
-        
+
         for i, content in enumerate(markdown_contents):
             combined_content += f"## Page {i+1}\n\n"
             combined_content += content
             combined_content += "\n\n---\n\n"
-        
+
         return combined_content
-    
-    def get_available_threads(self):
-        """Calculate available threads based on CPU and memory usage."""
-        total_cores = os.cpu_count() or 1  # Get total CPU cores, default to 1 if None
-        free_memory = psutil.virtual_memory().available / (1024 ** 3)  # Convert to GB
-        current_cpu_usage = psutil.cpu_percent(interval=1)  # Measure CPU usage over 1 sec
-
-        # Adjust max threads based on CPU and memory
-        if current_cpu_usage > 80:  # If CPU is heavily loaded, reduce threads
-            max_threads = max(2, total_cores // 2)
-        elif free_memory < 1:  # If available memory is low, reduce threads
-            max_threads = max(2, total_cores // 2)
-        else:
-            max_threads = total_cores * 2  # Default: Allow 2x CPU cores for I/O tasks
 
-        return max_threads
+    def cached_document(self, pdf_path: str):
+        """Return (document cache key, cached markdown or None); re-uploads of the same document are answered from the cache"""
+        if self.document_pages is not None:
+            return None, None  # Cascade output is cached by ConverterByCascade
+
+        document_key = make_cache_key(
+            "gpt", file_hash(pdf_path), ocr_pool.model_key, OCR_PROMPT_VARIANT,
+            NATIVE_TEXT_FAST_PATH, NATIVE_TEXT_LLM_FORMAT, SKIP_BLANK_PAGES, DEDUPLICATE_PAGES, VISION_BATCH_SIZE
+        )
+        cached_content = result_cache.get(document_key)
+        if cached_content is not None:
+            print("Document served from cache")
+            self.report["document_cache_hit"] = True
+        return document_key, cached_content
+
+    def start_conversion(self, pdf_path: str):
+        """Sort the pages of the spooled PDF into resumed, text and vision pages"""
+        # Created only once the document is not served from cache, so a cache hit leaves nothing to clean up
+        Path(self.temp_dir).mkdir(parents=True, exist_ok=True)
+        self.temp_files = []
+
+        # Poppler renders straight from the spooled upload, window by window
+        self.source_path = pdf_path
+
+        total_pages = self.get_page_count(self.source_path)
+        self.total_pages = total_pages
+        self.markdown_contents = [None] * total_pages  # Pre-allocate list to maintain order
+
+        # Pages checkpointed by an earlier attempt are reused as they are
+        self.resumed_pages = {page_num: content for page_num, content in self.checkpoint.items() if page_num < total_pages}
+        for page_num, content in self.resumed_pages.items():
+            self.markdown_contents[page_num] = content
+        if self.resumed_pages:
+            print(f"Resuming with {len(self.resumed_pages)}/{total_pages} pages already converted")
+
+        # In cascade mode only the pages escalated from Document Intelligence are left to convert
+        document_pages = {
+            page_num: content for page_num, content in (self.document_pages or {}).items()
+            if page_num < total_pages and page_num not in self.resumed_pages
+        }
+        for page_num, content in document_pages.items():
+            self.markdown_contents[page_num] = content
+        settled_pages = self.resumed_pages.keys() | document_pages.keys()
+
+        # Born-digital pages go through their text layer instead of vision OCR; they are found as each window is rendered
+        self.page_routes = ["vision"] * total_pages
+        for page_num in self.resumed_pages:
+            self.page_routes[page_num] = "resumed"
+        for page_num in document_pages:
+            self.page_routes[page_num] = "document"
+            self.emit_page(page_num, document_pages[page_num], total_pages)
+        self.text_pages = {}
+        self.render_pages = [page_num for page_num in range(total_pages) if page_num not in settled_pages]
+
+        # Blank pages get canned markdown and near-duplicate pages reuse an earlier result
+        self.seen_hashes = []
+        self.duplicates = {}
+
+        # With batching on, pages are grouped up to VISION_BATCH_SIZE and the image-token budget
+        self.batch = []
+        self.batch_tokens = 0
+        self.started = time.monotonic()
+
+    def route_page(self, payload):
+        """Settle blank and duplicate pages at once; return the pages, if any, that are now ready to be sent"""
+        # Preprocessing may have run in another process, so its timings travel with the payload
+        for stage, seconds in payload.timings.items():
+            self.timings.add(stage, seconds)
+        if payload.encodes:
+            metrics.inc("pdf2md_image_encodes_total", payload.encodes)
+        # Recorded before any page is settled here, so every spilled file is removed with the temp directory
+        if payload.spill_path:
+            self.temp_files.append(payload.spill_path)
+
+        if payload.text is not None:
+            self.text_pages[payload.page_num] = payload.text
+            self.page_routes[payload.page_num] = "text"
+            return [payload]
+
+        if payload.is_blank:
+            self.markdown_contents[payload.page_num] = BLANK_PAGE_MARKDOWN
+            self.page_routes[payload.page_num] = "blank"
+            self.emit_page(payload.page_num, BLANK_PAGE_MARKDOWN, self.total_pages)
+            return []
+
+        if payload.page_hash is not None:
+            duplicate_of = self.find_duplicate(payload.page_hash, self.seen_hashes)
+            if duplicate_of is not None:
+                # Reuse the earlier page's result once it is available
+                self.duplicates[payload.page_num] = duplicate_of
+                self.page_routes[payload.page_num] = "duplicate"
+                return []
+            self.seen_hashes.append((payload.page_hash, payload.page_num))
+
+        payload.queued_at = time.monotonic()
+        if VISION_BATCH_SIZE <= 1:
+            return [payload]
+
+        ready = []
+        image_tokens = estimate_image_tokens(payload.width, payload.height)
+        if self.batch and (len(self.batch) >= VISION_BATCH_SIZE or self.batch_tokens + image_tokens > VISION_BATCH_MAX_IMAGE_TOKENS):
+            ready = self.take_batch()
+        self.batch.append(payload)
+        self.batch_tokens += image_tokens
+        return ready
+
+    def take_batch(self):
+        """Hand out the pages batched so far"""
+        batch = self.batch
+        self.batch = []
+        self.batch_tokens = 0
+        return batch
+
+    def store_results(self, result):
+        """Place finished pages, a (page_num, markdown) pair or a list of them, and report each one"""
+        for page_num, content in (result if isinstance(result, list) else [result]):
+            self.markdown_contents[page_num] = content
+            self.emit_page(page_num, content, self.total_pages)
+
+    def finish_conversion(self, document_key: str):
+        """Fill in duplicate pages, complete the report and return the combined markdown"""
+        markdown_contents = self.markdown_contents
+        page_routes = self.page_routes
+        for page_num, duplicate_of in self.duplicates.items():
+            markdown_contents[page_num] = markdown_contents[duplicate_of]
+            if duplicate_of in self.failed_page_nums:
+                self.failed_page_nums.add(page_num)
+            self.emit_page(page_num, markdown_contents[page_num], self.total_pages)
+
+        blank_pages = page_routes.count("blank")
+        self.report.update({
+            "total_pages": self.total_pages,
+            "vision_pages": page_routes.count("vision"),
+            "text_pages": len(self.text_pages),
+            "blank_pages": blank_pages,
+            "duplicate_pages": len(self.duplicates),
+            "resumed_pages": len(self.resumed_pages),
+            "page_routes": page_routes
+        })
+        if self.document_pages is not None:
+            self.report["document_pages"] = page_routes.count("document")
+        print(f"Page routes: {self.report['vision_pages']} vision, {len(self.text_pages)} text, {blank_pages} blank, {len(self.duplicates)} duplicate")
+
+        elapsed = time.monotonic() - self.started
+        self.timings.add("total", elapsed)
+        for route in set(page_routes):
+            metrics.inc("pdf2md_pages_total", page_routes.count(route), route=route)
+        self.report["conversion_seconds"] = elapsed
+        self.report["pages_per_second"] = self.total_pages / elapsed if elapsed > 0 else None
+        if VISION_BATCH_SIZE > 1:
+            # Each batch replaced one request per page it carried
+            self.report["api_calls_saved"] = self.report.get("batched_pages", 0) - self.report.get("batch_requests", 0)
+            print(f"Batching: {self.report.get('batched_pages', 0)} pages in {self.report.get('batch_requests', 0)} requests, "
+                  f"{self.report.get('batch_fallback_pages', 0)} pages fell back to single requests")
+
+        # Combine all markdown content
+        print("Combining markdown content...")
+        final_content = self.combine_markdown_files(markdown_contents)
+
+        if SAVE_TO_MARKDOWN:
+            # Save markdown content to file
+            with open("markdown_gpt.md", 'w', encoding='utf-8') as f:
+                f.write(final_content)
+
+        # Only cache documents where every page converted cleanly
+        if document_key is not None and self.report["failed_pages"] == 0:
+            result_cache.set(document_key, final_content)
+
+        # Cleanup temporary files and directories
+        for temp_file in self.temp_files:
+            os.remove(temp_file)
+        os.removedirs(self.temp_dir)
+
+        print(f"Conversion complete!")
+        return final_content
+
+    def cleanup_conversion(self):
+        """Remove what a failed conversion left in its temp directory"""
+        for temp_file in getattr(self, "temp_files", []):
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        if os.path.exists(self.temp_dir):
+            os.removedirs(self.temp_dir)
 
-    def convert_pdf(self, pdf_content: bytes):
+    def convert_pdf(self, pdf_path: str):
         """Main conversion process"""
+        document_key, cached_content = self.cached_document(pdf_path)
+        if cached_content is not None:
+            return cached_content
+
         try:
-            # Split PDF into images
-            print("Converting PDF pages to images...")
-            image_paths = self.split_pdf_to_images(pdf_content)
-            
-            # Convert each image to markdown using thread pool
-            print("Converting images to markdown using parallel processing...")
-            markdown_contents = [None] * len(image_paths)  # Pre-allocate list to maintain order
-            
-            # Create list of tuples with (image_path, page_number)
-            image_tasks = [(path, idx) for idx, path in enumerate(image_paths)]
-            
-            # Process images in parallel with max threads
-            max_threads = min(self.get_available_threads(), len(image_tasks), MAX_THREADS)
-            print(f">>>> Using {max_threads} threads.")
+            self.start_conversion(pdf_path)
 
+            # Threads mostly wait on the API; each deployment's shared AIMD gate decides how many calls are in flight
+            max_threads = max(1, min(self.total_pages, MAX_THREADS))
+            print(f">>>> Using {max_threads} threads across {ocr_pool.size} OCR deployment(s).")
+
+            # Stream pages into the worker pool as soon as each one is rendered
+            print("Converting PDF pages to markdown using streaming parallel processing...")
             with ThreadPoolExecutor(max_workers=max_threads) as executor:
-                # Submit all tasks and create future-to-index mapping
-                future_to_page = {
-                    executor.submit(self.image_to_markdown, task): task[1]
-                    for task in image_tasks
-                }
-                
-                # Process completed futures and store results in order
-                for future in as_completed(future_to_page):
-                    page_num, content = future.result()
-                    markdown_contents[page_num] = content
-            
-            # Combine all markdown content
-            print("Combining markdown content...")
-            final_content = self.combine_markdown_files(markdown_contents)
-
-            if SAVE_TO_MARKDOWN:
-                # Save markdown content to file
-                with open("markdown_gpt.md", 'w', encoding='utf-8') as f:
-                    f.write(final_content)
-            
-            # Cleanup temporary files and directories
-            for image_path in image_paths:
-                os.remove(image_path)
-            os.removedirs(self.temp_dir)
-                
-            print(f"Conversion complete!")
-            return final_content
-            
+                pending = set()
+                for payload in self.iter_pdf_images(self.source_path, self.render_pages):
+                    pages = self.route_page(payload)
+                    if pages:
+                        pending.add(executor.submit(self.convert_pages, pages))
+
+                    # Store pages as soon as they finish, while later ones still render, so they are streamed
+                    # and checkpointed right away
+                    done, pending = wait(pending, timeout=0, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.store_results(future.result())
+
+                pages = self.take_batch()
+                if pages:
+                    pending.add(executor.submit(self.convert_pages, pages))
+
+                for future in as_completed(pending):
+                    self.store_results(future.result())
+
+            return self.finish_conversion(document_key)
+
         except Exception as e:
             print(f"An error occurred: {str(e)}")
             # Cleanup on error
-            for image_path in image_paths:
-                if os.path.exists(image_path):
-                    os.remove(image_path)
-            if os.path.exists(self.temp_dir):
-                os.removedirs(self.temp_dir)
+            self.cleanup_conversion()
+            raise
+
+    async def convert_pdf_async(self, pdf_path: str):
+        """convert_pdf() on the async engine: every page is a coroutine on the event loop instead of a thread"""
+        document_key, cached_content = await asyncio.to_thread(self.cached_document, pdf_path)
+        if cached_content is not None:
+            return cached_content
+
+        tasks = []
+        try:
+            await asyncio.to_thread(self.start_conversion, pdf_path)
+
+            # At most MAX_THREADS pages of this job wait on the API at once; the AIMD gates still bound each deployment
+            semaphore = asyncio.Semaphore(MAX_THREADS)
+            async def convert(coroutine):
+                async with semaphore:
+                    self.store_results(await coroutine)
+
+            print("Converting PDF pages to markdown using the async engine...")
+            # Rendering stays on the preprocessing pool; a thread only waits for its next finished page
+            payloads = self.iter_pdf_images(self.source_path, self.render_pages)
+            while True:
+                payload = await asyncio.to_thread(next, payloads, None)
+                if payload is None:
+                    break
+                pages = self.route_page(payload)
+                if pages:
+                    tasks.append(asyncio.create_task(convert(self.convert_pages_async(pages))))
+
+            pages = self.take_batch()
+            if pages:
+                tasks.append(asyncio.create_task(convert(self.convert_pages_async(pages))))
+
+            await asyncio.gather(*tasks)
+            return await asyncio.to_thread(self.finish_conversion, document_key)
+
+        except BaseException as e:
+            print(f"An error occurred: {str(e)}")
+            for task in tasks:
+                task.cancel()
+            self.cleanup_conversion()
             raise
 
 class ConverterByDocumentIntelligence:
-    def format_with_openai(self, markdown_content):
-        client = AzureOpenAI(
-            api_key=DI_AZURE_OPENAI_KEY,
-            api_version=DI_AZURE_OPENAI_API_VERSION,
-            azure_endpoint=DI_AZURE_OPENAI_ENDPOINT
-        )
+    def __init__(self, job_id: str = "", on_chunk=None, checkpoint=None):
+        # Rate limiters take turns between jobs, so one large document cannot hold a deployment's budget
+        self.job_id = job_id
+
+        # Per-job report of cache use and formatting fallbacks
+        self.report = {"chunk_cache_hits": 0, "format_failed": False}
+        self.report_lock = threading.Lock()
+        self.timings = StageTimings("document")
+
+        # Optional on_chunk(chunk_index, page_nums, markdown, total_chunks), called as each chunk is analyzed
+        self.on_chunk = on_chunk
+
+        # {chunk_index: (first_page, last_page, markdown)} of chunks analyzed by an earlier attempt
+        self.checkpoint = checkpoint or {}
+
+        # {page_num: markdown and read quality of the page}, only collected by analyze_pages() for cascade mode
+        self.page_results = None
+
+    def emit_chunk(self, chunk_index: int, chunk_pages, content: str, total_chunks: int):
+        """Hand an analyzed chunk to the on_chunk callback; a failing callback never fails the conversion"""
+        if self.on_chunk is None:
+            return
+        try:
+            self.on_chunk(chunk_index, chunk_pages, content, total_chunks)
+        except Exception as e:
+            print(f"Could not report chunk {chunk_index + 1}: {str(e)}")
 
+    def format_request(self, window):
+        """Return (estimated tokens, completion arguments) for reformatting a window of pages"""
         prompt = """Please reformat this form content into clear, well-structured markdown. 
         Requirements:
         1. Preserve all form fields, instructions, and text
@@ -788,93 +1143,610 @@ class ConverterByDocumentIntelligence:
         6. Group related fields together
         7. Make it highly readable
         8. INCLUDE EVERYTHING FROM THE ORIGINAL MARKDOWN - all check boxes and info should be included, even fields that were not filled out should be present.
-        9. include the page numbers on every top page.
+        9. Do not add page numbers or page headings; they are added afterwards.
 
+        """
+        if len(window) == 1:
+            markdown_content = window[0][2]
+        else:
+            prompt += FORMAT_BATCH_INSTRUCTIONS.format(count=len(window))
+            markdown_content = "\n\n".join(f"<<<PAGE {first_page + 1}>>>\n{content}" for first_page, _, content in window)
+        prompt += """
         Original form content:
         """
+        return estimate_text_tokens(prompt + markdown_content) + ESTIMATED_COMPLETION_TOKENS * len(window), {
+            "messages": [
+                {
+                    "role": "user",
+                    "content": prompt + markdown_content
+                }
+            ],
+            "frequency_penalty": 0,
+            "presence_penalty": 0,
+            "stop": None
+        }
+
+    def record_format(self, member, response, latency: float):
+        self.timings.add("format_llm", latency)
+        metrics.observe("pdf2md_request_seconds", latency, pool="di", deployment=member.name, outcome="ok")
+        metrics.inc("pdf2md_requests_total", pool="di", deployment=member.name, outcome="ok")
+        prompt_tokens, cached_tokens, completion_tokens = usage_breakdown(response)
+        metrics.inc("pdf2md_tokens_total", prompt_tokens, deployment=member.name, kind="prompt")
+        metrics.inc("pdf2md_tokens_total", cached_tokens, deployment=member.name, kind="cached")
+        metrics.inc("pdf2md_tokens_total", completion_tokens, deployment=member.name, kind="completion")
+
+    def format_failed(self, member, error, attempt: int, tried):
+        """Record a failed formatting call. Returns the seconds to wait before trying again (0 to move to
+        another deployment at once), or None when the window is left unformatted."""
+        print(f"Error calling Azure OpenAI: {str(error)}")
+        if member is not None:
+            metrics.inc("pdf2md_requests_total", pool="di", deployment=member.name, outcome="error")
+        if member is not None and is_transient(error) and len(tried) < di_pool.size:
+            metrics.inc("pdf2md_retries_total", pool="di", reason="failover")
+            return 0
+        # With no other deployment left, back off and retry the same one, as the SDK retries used to
+        if (is_transient(error) or is_rate_limited(error)) and attempt < RATE_LIMIT_RETRY_MAX_COUNT - 1:
+            wait_time = retry_after_seconds(error) or RATE_LIMIT_RETRY_DELAY * (2 ** attempt)
+            print(f"Retrying formatting in {wait_time:.2f} seconds... (Attempt {attempt + 1}/{RATE_LIMIT_RETRY_MAX_COUNT})")
+            metrics.inc("pdf2md_retries_total", pool="di", reason="rate_limit" if is_rate_limited(error) else "transient")
+            metrics.inc("pdf2md_backoff_seconds_total", wait_time, pool="di")
+            return wait_time
+        with self.report_lock:
+            self.report["format_failed"] = True
+        return None
+
+    @staticmethod
+    def format_units(chunks, markdown_contents):
+        """Split analyzed chunks on their page breaks into (first_page, last_page, markdown) units;
+        a chunk whose page breaks do not match its pages stays whole"""
+        units = []
+        for chunk_pages, content in zip(chunks, markdown_contents):
+            pages = content.split("<!-- PageBreak -->")
+            if len(pages) == len(chunk_pages):
+                units.extend((page_num, page_num, page.strip()) for page_num, page in zip(chunk_pages, pages))
+            else:
+                units.append((chunk_pages[0], chunk_pages[-1], content.strip()))
+        return units
+
+    @staticmethod
+    def plan_format_windows(units):
+        """Group consecutive units into windows of up to FORMAT_WINDOW_PAGES units and FORMAT_WINDOW_TOKENS estimated tokens"""
+        windows = []
+        window = []
+        window_tokens = 0
+        for unit in units:
+            unit_tokens = estimate_text_tokens(unit[2])
+            if window and (len(window) >= FORMAT_WINDOW_PAGES or window_tokens + unit_tokens > FORMAT_WINDOW_TOKENS):
+                windows.append(window)
+                window = []
+                window_tokens = 0
+            window.append(unit)
+            window_tokens += unit_tokens
+        if window:
+            windows.append(window)
+        return windows
+
+    def cached_window(self, window):
+        """Return (window cache key, cached formatted sections or None)"""
+        window_key = make_cache_key("di_format", content_hash(json.dumps(window)), di_pool.model_key)
+        cached_window = result_cache.get(window_key)
+        if cached_window is not None:
+            with self.report_lock:
+                self.report["format_cache_hits"] = self.report.get("format_cache_hits", 0) + 1
+            cached_window = json.loads(cached_window)
+        return window_key, cached_window
+
+    def window_formatted(self, window, window_key: str, content: str):
+        """Formatted sections of a window in order; None when a multi-page answer cannot be split back into its pages"""
+        if len(window) == 1:
+            sections = [content]
+        else:
+            split = ConverterByGPT.split_batch_output(content)
+            if sorted(split) != [first_page for first_page, _, _ in window] or not all(split.values()):
+                print(f">>>> Formatted pages {window[0][0] + 1} to {window[-1][1] + 1} could not be split; formatting them one by one")
+                with self.report_lock:
+                    self.report["format_fallback_pages"] = self.report.get("format_fallback_pages", 0) + len(window)
+                return None
+            sections = [split[first_page] for first_page, _, _ in window]
+        result_cache.set(window_key, json.dumps(sections))
+        return sections
+
+    def format_completion(self, window):
+        """Format one window, on another deployment after a transient error; None when formatting failed"""
+        estimated_tokens, request = self.format_request(window)
+
+        # Transient errors move to another deployment while the pool has one, then back off on the same one
+        tried = set()
+        for attempt in range(RATE_LIMIT_RETRY_MAX_COUNT):
+            member = None  # Still None in the handler if no deployment could be chosen
+            try:
+                with di_pool.use(avoid=tried) as member:
+                    tried.add(member.name)
+                    with self.timings.time("admission_wait"):
+                        ticket = member.limiter.acquire(estimated_tokens, self.job_id)
+                    start = time.monotonic()
+                    response = member.get_client().chat.completions.create(
+                        model=member.deployment,  # o3-mini deployment
+                        **request
+                    )
+                    latency = time.monotonic() - start
+                    member.limiter.settle(ticket, usage_tokens(response))
+
+                self.record_format(member, response, latency)
+                return response.choices[0].message.content or ""
+            except Exception as e:
+                wait_time = self.format_failed(member, e, attempt, tried)
+                if wait_time is None:
+                    return None
+                with self.timings.time("backoff"):
+                    time.sleep(wait_time)
+        return None
 
-        try:
-            response = client.chat.completions.create(
-                model=DI_AZURE_DEPLOYMENT_NAME,  # o3-mini deployment
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt + markdown_content
-                    }
-                ],
-                frequency_penalty=0,
-                presence_penalty=0,
-                stop=None
-            )
-            
-            return response.choices[0].message.content
-        except Exception as e:
-            print(f"Error calling Azure OpenAI: {str(e)}")
-            return markdown_content  # Return original content if formatting fails
+    async def format_completion_async(self, window):
+        """format_completion() on the async engine"""
+        estimated_tokens, request = self.format_request(window)
 
-    def convert_pdf(self, pdf_content: bytes):
-        try:
-            # Initialize the client
-            document_client = DocumentIntelligenceClient(
-                endpoint=AZURE_DOCUMENT_ENDPOINT,
-                credential=AzureKeyCredential(AZURE_DOCUMENT_KEY)
-            )
+        tried = set()
+        for attempt in range(RATE_LIMIT_RETRY_MAX_COUNT):
+            member = None  # Still None in the handler if no deployment could be chosen
+            try:
+                with di_pool.use(avoid=tried) as member:
+                    tried.add(member.name)
+                    with self.timings.time("admission_wait"):
+                        ticket = await member.limiter.acquire_async(estimated_tokens, self.job_id)
+                    start = time.monotonic()
+                    response = await member.get_async_client().chat.completions.create(model=member.deployment, **request)
+                    latency = time.monotonic() - start
+                    await member.limiter.settle_async(ticket, usage_tokens(response))
+
+                self.record_format(member, response, latency)
+                return response.choices[0].message.content or ""
+            except Exception as e:
+                wait_time = self.format_failed(member, e, attempt, tried)
+                if wait_time is None:
+                    return None
+                with self.timings.time("backoff"):
+                    await asyncio.sleep(wait_time)
+        return None
+
+    def format_window(self, window):
+        """Formatted markdown of each unit in a window; units that could not be formatted keep their original markdown"""
+        window_key, sections = self.cached_window(window)
+        if sections is not None:
+            return sections
+
+        content = self.format_completion(window)
+        if content is None:
+            return [unit_content for _, _, unit_content in window]  # Keep the original content if formatting fails
+        sections = self.window_formatted(window, window_key, content)
+        if sections is None:
+            sections = [self.format_window([unit])[0] for unit in window]
+        return sections
+
+    async def format_window_async(self, window):
+        """format_window() on the async engine; fallback units are formatted concurrently"""
+        window_key, sections = await asyncio.to_thread(self.cached_window, window)
+        if sections is not None:
+            return sections
+
+        content = await self.format_completion_async(window)
+        if content is None:
+            return [unit_content for _, _, unit_content in window]
+        sections = await asyncio.to_thread(self.window_formatted, window, window_key, content)
+        if sections is None:
+            sections = [unit_sections[0] for unit_sections in await asyncio.gather(*(self.format_window_async([unit]) for unit in window))]
+        return sections
+
+    @staticmethod
+    def stitch_formatted(windows, formatted_windows):
+        """Join formatted units in page order under page headers written here rather than by the model"""
+        combined_content = ""
+        for window, sections in zip(windows, formatted_windows):
+            for (first_page, last_page, _), content in zip(window, sections):
+                if first_page == last_page:
+                    combined_content += f"## Page {first_page + 1}\n\n"
+                else:
+                    combined_content += f"## Pages {first_page + 1}-{last_page + 1}\n\n"
+                combined_content += content
+                combined_content += "\n\n---\n\n"
+        return combined_content
+
+    def format_with_openai(self, chunks, markdown_contents):
+        """Format the analyzed chunks window by window, concurrently, instead of in one call over the whole document"""
+        windows = self.plan_format_windows(self.format_units(chunks, markdown_contents))
+        self.report["format_windows"] = len(windows)
+        max_workers = max(1, min(FORMAT_MAX_CONCURRENT_WINDOWS, len(windows)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            formatted_windows = list(executor.map(self.format_window, windows))
+        return self.stitch_formatted(windows, formatted_windows)
+
+    async def format_with_openai_async(self, chunks, markdown_contents):
+        """format_with_openai() on the async engine"""
+        windows = self.plan_format_windows(self.format_units(chunks, markdown_contents))
+        self.report["format_windows"] = len(windows)
+        semaphore = asyncio.Semaphore(max(1, FORMAT_MAX_CONCURRENT_WINDOWS))
+        async def format_window(window):
+            async with semaphore:
+                return await self.format_window_async(window)
+
+        formatted_windows = await asyncio.gather(*(format_window(window) for window in windows))
+        return self.stitch_formatted(windows, formatted_windows)
+
+    @staticmethod
+    def serialized_size(pages):
+        """Size in bytes of a standalone PDF containing the given pages"""
+        pdf_writer = PdfWriter()
+        for page in pages:
+            pdf_writer.add_page(page)
+        chunk_bytes = io.BytesIO()
+        pdf_writer.write(chunk_bytes)
+        return chunk_bytes.tell()
+
+    @staticmethod
+    def page_objects(page, object_sizes):
+        """{object number: serialized size} of the page and every indirect object it uses, such as fonts and images.
+        object_sizes caches the sizes across pages, so each shared object is serialized once."""
+        objects = {}
+        pending = [page.indirect_reference]
+        while pending:
+            obj = pending.pop()
+            if isinstance(obj, IndirectObject):
+                if obj.idnum in objects:
+                    continue
+                resolved = obj.get_object()
+                if obj.idnum not in object_sizes:
+                    object_bytes = io.BytesIO()
+                    resolved.write_to_stream(object_bytes, None)
+                    object_sizes[obj.idnum] = object_bytes.tell() + PDF_OBJECT_OVERHEAD
+                objects[obj.idnum] = object_sizes[obj.idnum]
+                pending.append(resolved)
+            elif isinstance(obj, DictionaryObject):
+                # The parent links back to the page tree, which a chunk gets its own copy of
+                pending.extend(value for key, value in obj.items() if key != "/Parent")
+            elif isinstance(obj, ArrayObject):
+                pending.extend(obj)
+        return objects
+
+    def plan_chunks(self, pdf_reader):
+        """Pack page numbers into chunks under CHUNK_SIZE, measuring each indirect object once"""
+        max_chunk_size_bytes = CHUNK_SIZE * 1024 * 1024    # bytes
+
+        # Header, trailer and xref are paid once per chunk, not once per page
+        file_overhead = self.serialized_size([])
+
+        object_sizes = {}
+        chunks = []
+        current_chunk = []
+        current_objects = set()
+        current_chunk_size = file_overhead
+        for page_num, page in enumerate(pdf_reader.pages):
+            # A font or image shared by several pages is written once per chunk, so it only counts once
+            page_objects = self.page_objects(page, object_sizes)
+            added_size = sum(size for idnum, size in page_objects.items() if idnum not in current_objects)
+
+            if current_chunk and current_chunk_size + added_size > max_chunk_size_bytes:
+                chunks.append(current_chunk)
+                current_chunk = []
+                current_objects = set()
+                current_chunk_size = file_overhead
+                added_size = sum(page_objects.values())
+
+            current_chunk.append(page_num)
+            current_objects.update(page_objects)
+            current_chunk_size += added_size
+
+        if current_chunk:
+            chunks.append(current_chunk)
+        return chunks
+
+    def build_chunk(self, pdf_reader, page_nums):
+        """Serialize the given pages into a single chunk, written exactly once"""
+        pdf_writer = PdfWriter()
+        for page_num in page_nums:
+            pdf_writer.add_page(pdf_reader.pages[page_num])
+        chunk_bytes = io.BytesIO()
+        pdf_writer.write(chunk_bytes)
+        return chunk_bytes.getvalue()
+
+    def cached_chunk(self, chunk_bytes: bytes, chunk_pages):
+        """Return (chunk cache key, cached markdown or None); unchanged chunks of a re-submitted document skip analysis"""
+        print(f"Processing pages {chunk_pages[0] + 1} to {chunk_pages[-1] + 1}...")
+        if self.page_results is None:
+            chunk_key = make_cache_key("di_chunk", content_hash(chunk_bytes))
+        else:
+            chunk_key = make_cache_key("di_chunk_pages", content_hash(chunk_bytes))
+        cached_chunk = result_cache.get(chunk_key)
+        if cached_chunk is not None:
+            with self.report_lock:
+                self.report["chunk_cache_hits"] += 1
+            if self.page_results is not None:
+                cached = json.loads(cached_chunk)
+                self.store_pages(chunk_pages, cached["pages"])
+                cached_chunk = cached["content"]
+        return chunk_key, cached_chunk
+
+    @staticmethod
+    def page_signals(result):
+        """Markdown of each page of an analyzed chunk, with the signals cascade mode escalates on"""
+        handwritten_spans = [span for style in result.styles or [] if style.is_handwritten for span in style.spans]
+        def on_page(span, page_spans):
+            return any(span.offset < page_span.offset + page_span.length and page_span.offset < span.offset + span.length
+                       for page_span in page_spans)
+
+        pages = []
+        for page in result.pages or []:
+            page_spans = page.spans or []
+            words = page.words or []
+            marks = page.selection_marks or []
+            markdown = "".join(result.content[span.offset:span.offset + span.length] for span in page_spans)
+            pages.append({
+                "index": page.page_number - 1,  # Within the chunk, so a cached chunk fits wherever it recurs
+                "markdown": markdown.replace("<!-- PageBreak -->", "").strip(),
+                "word_confidence": sum(word.confidence for word in words) / len(words) if words else None,
+                "selection_mark_confidence": min((mark.confidence for mark in marks), default=None),
+                "handwritten": any(on_page(span, page_spans) for span in handwritten_spans)
+            })
+        return pages
+
+    def store_pages(self, chunk_pages, pages):
+        with self.report_lock:
+            for page in pages:
+                self.page_results[chunk_pages[page["index"]]] = page
+
+    def chunk_analyzed(self, member, chunk_key: str, chunk_pages, result, latency: float):
+        metrics.observe("pdf2md_request_seconds", latency, pool="document", deployment=member.name, outcome="ok")
+        metrics.inc("pdf2md_requests_total", pool="document", deployment=member.name, outcome="ok")
+        if self.page_results is None:
+            result_cache.set(chunk_key, result.content)
+        else:
+            pages = self.page_signals(result)
+            self.store_pages(chunk_pages, pages)
+            result_cache.set(chunk_key, json.dumps({"content": result.content, "pages": pages}))
+        print(f"Pages {chunk_pages[0] + 1} to {chunk_pages[-1] + 1} analyzed")
+        return result.content
+
+    def chunk_retry_delay(self, member, error, attempt: int, failovers: int, max_retries: int, base_delay: float):
+        """Seconds to wait before analyzing a chunk again, or None to move to another endpoint at once.
+        Raises error when it cannot be retried."""
+        error_message = str(error).lower()
+        if member is not None:
+            metrics.inc("pdf2md_requests_total", pool="document", deployment=member.name, outcome="error")
+        if member is not None and is_transient(error) and failovers < document_pool.size - 1:
+            print(f"Error occurred on {member.name}: {error_message}. Retrying on another endpoint...")
+            metrics.inc("pdf2md_retries_total", pool="document", reason="failover")
+            return None
+        if is_transient(error):
+            wait_time = base_delay * (2 ** attempt)
+            print(f"Error occurred: {error_message}. Retrying in {wait_time} seconds... (Attempt {attempt + 1}/{max_retries})")
+            metrics.inc("pdf2md_retries_total", pool="document", reason="transient")
+            metrics.inc("pdf2md_backoff_seconds_total", wait_time, pool="document")
+            return wait_time
+        print(f"An unexpected error occurred: {error_message}")
+        raise error
+
+    def analyze_chunk(self, chunk_bytes: bytes, chunk_pages):
+        """Analyze one chunk with prebuilt-layout, retrying on timeouts and dropped connections, on another endpoint when there is one"""
+        chunk_key, cached_chunk = self.cached_chunk(chunk_bytes, chunk_pages)
+        if cached_chunk is not None:
+            return cached_chunk
+
+        # Process the chunk with retry mechanism
+        max_retries = RATE_LIMIT_RETRY_MAX_COUNT
+        base_delay = RATE_LIMIT_RETRY_DELAY
+
+        failovers = 0
+        tried = set()
+        for attempt in range(max_retries):
+            member = None  # Still None in the handler if no endpoint could be chosen
+            try:
+                with document_pool.use(avoid=tried) as member:
+                    tried.add(member.name)
+                    with self.timings.time("admission_wait"):
+                        member.limiter.acquire(0, self.job_id)  # Endpoints may set a requests_per_minute quota
+                    start = time.monotonic()
+                    with self.timings.time("di_upload"):
+                        poller = member.get_client().begin_analyze_document(
+                            "prebuilt-layout",
+                            body=chunk_bytes,
+                            content_type="application/pdf",
+                            output_content_format=DocumentContentFormat.MARKDOWN
+                        )
+
+                    with self.timings.time("di_poll"):
+                        result = poller.result()
+                return self.chunk_analyzed(member, chunk_key, chunk_pages, result, time.monotonic() - start)
+
+            except Exception as e:
+                wait_time = self.chunk_retry_delay(member, e, attempt, failovers, max_retries, base_delay)
+                if wait_time is None:
+                    failovers += 1
+                    continue
+                with self.timings.time("backoff"):
+                    time.sleep(wait_time)
+
+        raise Exception(f"Max retries exceeded while analyzing pages {chunk_pages[0] + 1} to {chunk_pages[-1] + 1}.")
 
-            print("Begin analyzing document using Document Intelligence...")
+    async def analyze_chunk_async(self, chunk_bytes: bytes, chunk_pages):
+        """analyze_chunk() on the async engine, polling the operation without holding a thread"""
+        chunk_key, cached_chunk = await asyncio.to_thread(self.cached_chunk, chunk_bytes, chunk_pages)
+        if cached_chunk is not None:
+            return cached_chunk
 
-            pdf_reader = PdfReader(io.BytesIO(pdf_content))
+        max_retries = RATE_LIMIT_RETRY_MAX_COUNT
+        base_delay = RATE_LIMIT_RETRY_DELAY
+
+        failovers = 0
+        tried = set()
+        for attempt in range(max_retries):
+            member = None  # Still None in the handler if no endpoint could be chosen
+            try:
+                with document_pool.use(avoid=tried) as member:
+                    tried.add(member.name)
+                    with self.timings.time("admission_wait"):
+                        await member.limiter.acquire_async(0, self.job_id)
+                    start = time.monotonic()
+                    with self.timings.time("di_upload"):
+                        poller = await member.get_async_client().begin_analyze_document(
+                            "prebuilt-layout",
+                            body=chunk_bytes,
+                            content_type="application/pdf",
+                            output_content_format=DocumentContentFormat.MARKDOWN
+                        )
+
+                    with self.timings.time("di_poll"):
+                        result = await poller.result()
+                latency = time.monotonic() - start
+                return await asyncio.to_thread(self.chunk_analyzed, member, chunk_key, chunk_pages, result, latency)
+
+            except Exception as e:
+                wait_time = self.chunk_retry_delay(member, e, attempt, failovers, max_retries, base_delay)
+                if wait_time is None:
+                    failovers += 1
+                    continue
+                with self.timings.time("backoff"):
+                    await asyncio.sleep(wait_time)
+
+        raise Exception(f"Max retries exceeded while analyzing pages {chunk_pages[0] + 1} to {chunk_pages[-1] + 1}.")
+
+    def cached_document(self, pdf_path: str):
+        """Return (document cache key, cached markdown or None); re-uploads of the same document are answered from the cache"""
+        document_key = make_cache_key(
+            "di", file_hash(pdf_path), FORMAT_RAW_MARKDOWN_FROM_DI, di_pool.model_key, FORMAT_WINDOW_PAGES, FORMAT_WINDOW_TOKENS
+        )
+        cached_content = result_cache.get(document_key)
+        if cached_content is not None:
+            print("Document Intelligence result served from cache")
+            self.report["document_cache_hit"] = True
+        return document_key, cached_content
+
+    def start_conversion(self, pdf_reader):
+        """Plan the chunks up front from per-page sizes instead of re-serializing the growing chunk"""
+        print("Begin analyzing document using Document Intelligence...")
+        with self.timings.time("plan"):
+            chunks = self.plan_chunks(pdf_reader)
+        print(f"Split {len(pdf_reader.pages)} pages into {len(chunks)} chunks")
+        return chunks
+
+    def resumed_chunk(self, chunk_index: int, chunk_pages):
+        """Markdown of a checkpointed chunk; the chunk plan is deterministic, so a chunk with the same pages is reused"""
+        resumed = self.checkpoint.get(chunk_index)
+        if resumed is None or resumed[:2] != (chunk_pages[0], chunk_pages[-1]):
+            return None
+        self.report["resumed_chunks"] = self.report.get("resumed_chunks", 0) + 1
+        return resumed[2]
+
+    def finish_conversion(self, document_key: str, combined_markdown: str, formatted_markdown: str, started: float):
+        if SAVE_TO_MARKDOWN:
+            # Save both original and formatted markdown
+            with open(f"markdown_di_raw.md", "w", encoding="utf-8") as f:
+                f.write(combined_markdown)
+
+            if FORMAT_RAW_MARKDOWN_FROM_DI:
+                with open(f"markdown_di_formatted.md", "w", encoding="utf-8") as f:
+                    f.write(formatted_markdown)
+
+        if not self.report["format_failed"]:
+            result_cache.set(document_key, formatted_markdown)
+
+        self.timings.add("total", time.monotonic() - started)
+        print(f"Document Intelligence parsing complete!")
+        return formatted_markdown
+
+    def analyze_chunks(self, pdf_reader, chunks):
+        """Analyze chunks concurrently and return their markdown in page order"""
+        markdown_contents = [None] * len(chunks)
+        max_workers = max(1, min(DI_MAX_CONCURRENT_CHUNKS, len(chunks)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_to_chunk = {}
+            def collect(futures):
+                for future in futures:
+                    chunk_index = future_to_chunk.pop(future)
+                    markdown_contents[chunk_index] = future.result()
+                    self.emit_chunk(chunk_index, chunks[chunk_index], markdown_contents[chunk_index], len(chunks))
+
+            for chunk_index, chunk_pages in enumerate(chunks):
+                markdown_contents[chunk_index] = self.resumed_chunk(chunk_index, chunk_pages)
+                if markdown_contents[chunk_index] is not None:
+                    continue
+
+                # Only a few built chunks wait at a time, so the document is never copied whole into memory
+                if len(future_to_chunk) >= max_workers * 2:
+                    done, _ = wait(future_to_chunk, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+                # Chunks are built here because the reader is not safe to share across threads
+                with self.timings.time("build_chunk"):
+                    chunk_bytes = self.build_chunk(pdf_reader, chunk_pages)
+                future = executor.submit(self.analyze_chunk, chunk_bytes, chunk_pages)
+                future_to_chunk[future] = chunk_index
+
+            collect(as_completed(list(future_to_chunk)))
+        return markdown_contents
+
+    async def analyze_chunks_async(self, pdf_reader, chunks):
+        """analyze_chunks() on the async engine"""
+        markdown_contents = [None] * len(chunks)
+        semaphore = asyncio.Semaphore(max(1, DI_MAX_CONCURRENT_CHUNKS))
+        async def analyze(chunk_index: int, chunk_bytes: bytes):
+            try:
+                markdown_contents[chunk_index] = await self.analyze_chunk_async(chunk_bytes, chunks[chunk_index])
+            finally:
+                semaphore.release()
+            self.emit_chunk(chunk_index, chunks[chunk_index], markdown_contents[chunk_index], len(chunks))
+
+        tasks = []
+        try:
+            for chunk_index, chunk_pages in enumerate(chunks):
+                markdown_contents[chunk_index] = self.resumed_chunk(chunk_index, chunk_pages)
+                if markdown_contents[chunk_index] is not None:
+                    continue
+
+                # A chunk is only built once a slot is free to analyze it, and one build at a time,
+                # because the reader is not safe to share across threads
+                await semaphore.acquire()
+                with self.timings.time("build_chunk"):
+                    chunk_bytes = await asyncio.to_thread(self.build_chunk, pdf_reader, chunk_pages)
+                tasks.append(asyncio.create_task(analyze(chunk_index, chunk_bytes)))
+
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return markdown_contents
+
+    def analyze_pages(self, pdf_path: str):
+        """Analyze every chunk and return (total pages, {page_num: page signals}) for cascade mode"""
+        self.page_results = {}
+        started = time.monotonic()
+        with open_pdf(pdf_path) as pdf_reader:
+            chunks = self.start_conversion(pdf_reader)
+            self.analyze_chunks(pdf_reader, chunks)
+            total_pages = len(pdf_reader.pages)
+        self.timings.add("total", time.monotonic() - started)
+        return total_pages, self.page_results
+
+    async def analyze_pages_async(self, pdf_path: str):
+        """analyze_pages() on the async engine"""
+        self.page_results = {}
+        started = time.monotonic()
+        with open_pdf(pdf_path) as pdf_reader:
+            chunks = await asyncio.to_thread(self.start_conversion, pdf_reader)
+            await self.analyze_chunks_async(pdf_reader, chunks)
             total_pages = len(pdf_reader.pages)
-            
-            pdf_writer = PdfWriter()            
-            markdown_contents = []
-
-            max_chunk_size_bytes = CHUNK_SIZE * 1024 * 1024    # bytes
-            current_chunk_size = 0            
-
-            for page_num in range(total_pages):
-                # Add page to the current chunk
-                pdf_writer.add_page(pdf_reader.pages[page_num])
-
-                # Convert current chunk to bytes to check size
-                chunk_bytes = io.BytesIO()
-                pdf_writer.write(chunk_bytes)
-                current_chunk_size = len(chunk_bytes.getvalue())  # size in bytes
-
-                # If the current chunk exceeds the size limit, process it
-                if current_chunk_size >= max_chunk_size_bytes or page_num == total_pages - 1:
-                    print(f"Processing pages up to {page_num + 1}...")
-
-                    # Process the chunk with retry mechanism
-                    max_retries = RATE_LIMIT_RETRY_MAX_COUNT
-                    base_delay = RATE_LIMIT_RETRY_DELAY
-
-                    for attempt in range(max_retries):
-                        try:
-                            chunk_bytes.seek(0)
-                            poller = document_client.begin_analyze_document(
-                                "prebuilt-layout",
-                                body=chunk_bytes.getvalue(),
-                                content_type="application/pdf",
-                                output_content_format=DocumentContentFormat.MARKDOWN
-                            )
-
-                            result = poller.result()
-                            markdown_contents.append(result.content)
-                            break  # Exit loop if successful
-
-                        except Exception as e:
-                            error_message = str(e).lower()
-                            if "timeout" in error_message or "eof" in error_message:
-                                wait_time = base_delay * (2 ** attempt)
-                                print(f"Error occurred: {error_message}. Retrying in {wait_time} seconds... (Attempt {attempt + 1}/{max_retries})")
-                                time.sleep(wait_time)
-                            else:
-                                print(f"An unexpected error occurred: {error_message}")
-                                raise
-
-                    # Reset for the next chunk
-                    pdf_writer = PdfWriter()
-                    current_chunk_size = 0
+        self.timings.add("total", time.monotonic() - started)
+        return total_pages, self.page_results
+
+    def convert_pdf(self, pdf_path: str):
+        document_key, cached_content = self.cached_document(pdf_path)
+        if cached_content is not None:
+            return cached_content
+
+        try:
+            started = time.monotonic()
+            with open_pdf(pdf_path) as pdf_reader:
+                chunks = self.start_conversion(pdf_reader)
+                markdown_contents = self.analyze_chunks(pdf_reader, chunks)
 
             # Combine all markdown content
             combined_markdown = "\n\n---\n\n".join(markdown_contents)
@@ -882,22 +1754,134 @@ class ConverterByDocumentIntelligence:
             if FORMAT_RAW_MARKDOWN_FROM_DI:
                 print("Formatting markdown started with OpenAI...")
                 # Format the markdown with OpenAI
-                formatted_markdown = self.format_with_openai(combined_markdown)
+                formatted_markdown = self.format_with_openai(chunks, markdown_contents)
                 print("Formatting markdown completed with OpenAI...")
             else:
                 formatted_markdown = combined_markdown
 
-            if SAVE_TO_MARKDOWN:
-                # Save both original and formatted markdown
-                with open(f"markdown_di_raw.md", "w", encoding="utf-8") as f:
-                    f.write(combined_markdown)
+            return self.finish_conversion(document_key, combined_markdown, formatted_markdown, started)
+        except Exception as e:
+            print(f"An error occurred while parsing the document with Document Intelligence: {str(e)}")
+            raise
 
-                if FORMAT_RAW_MARKDOWN_FROM_DI:
-                    with open(f"markdown_di_formatted.md", "w", encoding="utf-8") as f:
-                        f.write(formatted_markdown)
+    async def convert_pdf_async(self, pdf_path: str):
+        """convert_pdf() on the async engine; planning and chunk building still run in a thread, off the event loop"""
+        document_key, cached_content = await asyncio.to_thread(self.cached_document, pdf_path)
+        if cached_content is not None:
+            return cached_content
 
-            print(f"Document Intelligence parsing complete!")
-            return formatted_markdown
-        except Exception as e:
+        try:
+            started = time.monotonic()
+            with open_pdf(pdf_path) as pdf_reader:
+                chunks = await asyncio.to_thread(self.start_conversion, pdf_reader)
+                markdown_contents = await self.analyze_chunks_async(pdf_reader, chunks)
+
+            combined_markdown = "\n\n---\n\n".join(markdown_contents)
+
+            if FORMAT_RAW_MARKDOWN_FROM_DI:
+                print("Formatting markdown started with OpenAI...")
+                formatted_markdown = await self.format_with_openai_async(chunks, markdown_contents)
+                print("Formatting markdown completed with OpenAI...")
+            else:
+                formatted_markdown = combined_markdown
+
+            return await asyncio.to_thread(self.finish_conversion, document_key, combined_markdown, formatted_markdown, started)
+        except BaseException as e:
             print(f"An error occurred while parsing the document with Document Intelligence: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+
+class ConverterByCascade:
+    """Document Intelligence reads every page first and only the pages it reads poorly go to vision GPT,
+    giving one output with a section per page"""
+    def __init__(self, converter_gpt: ConverterByGPT, converter_document: ConverterByDocumentIntelligence):
+        self.converter_gpt = converter_gpt
+        self.converter_document = converter_document
+
+        # Checkpointed chunks lack the per-page signals, so chunks are analyzed again (usually from the chunk cache);
+        # finished pages are still resumed from the GPT checkpoint
+        self.converter_document.checkpoint = {}
+
+        # Per-job report of how many pages were escalated and why
+        self.report = {"total_pages": 0, "document_pages": 0, "escalated_pages": 0, "escalations": {}}
+
+    def cached_document(self, pdf_path: str):
+        """Return (document cache key, cached markdown or None)"""
+        document_key = make_cache_key(
+            "cascade", file_hash(pdf_path), ocr_pool.model_key, OCR_PROMPT_VARIANT,
+            NATIVE_TEXT_FAST_PATH, NATIVE_TEXT_LLM_FORMAT, SKIP_BLANK_PAGES, DEDUPLICATE_PAGES, VISION_BATCH_SIZE,
+            CASCADE_MIN_WORD_CONFIDENCE, CASCADE_MIN_SELECTION_MARK_CONFIDENCE, CASCADE_ESCALATE_HANDWRITING
+        )
+        cached_content = result_cache.get(document_key)
+        if cached_content is not None:
+            print("Cascade result served from cache")
+            self.report["document_cache_hit"] = True
+        return document_key, cached_content
+
+    @staticmethod
+    def escalation_reason(page):
+        """Why a page needs vision GPT, or None when the Document Intelligence markdown can be used"""
+        if page is None:
+            return "missing"
+        if not page["markdown"]:
+            return "empty"  # Blank pages are then settled by the blank page check without an LLM call
+        if CASCADE_ESCALATE_HANDWRITING and page["handwritten"]:
+            return "handwriting"
+        if page["word_confidence"] is not None and page["word_confidence"] < CASCADE_MIN_WORD_CONFIDENCE:
+            return "low_confidence"
+        if page["selection_mark_confidence"] is not None and page["selection_mark_confidence"] < CASCADE_MIN_SELECTION_MARK_CONFIDENCE:
+            return "selection_marks"
+        return None
+
+    def escalate(self, total_pages: int, page_results):
+        """Hand the pages Document Intelligence read well to the GPT converter, which converts only the others"""
+        document_pages = {}
+        escalations = {}
+        for page_num in range(total_pages):
+            page = page_results.get(page_num)
+            reason = self.escalation_reason(page)
+            if reason is None:
+                document_pages[page_num] = page["markdown"]
+                continue
+            escalations[reason] = escalations.get(reason, 0) + 1
+            metrics.inc("pdf2md_cascade_escalations_total", reason=reason)
+
+        self.converter_gpt.document_pages = document_pages
+        self.report.update({
+            "total_pages": total_pages,
+            "document_pages": len(document_pages),
+            "escalated_pages": total_pages - len(document_pages),
+            "escalations": escalations
+        })
+        print(f"Cascade: {self.report['escalated_pages']}/{total_pages} pages escalated to vision GPT {escalations}")
+
+    def finish_conversion(self, document_key: str, content: str):
+        # Only cache documents where every escalated page converted cleanly
+        if self.converter_gpt.report["failed_pages"] == 0:
+            result_cache.set(document_key, content)
+        return content
+
+    def convert_pdf(self, pdf_path: str):
+        document_key, cached_content = self.cached_document(pdf_path)
+        if cached_content is not None:
+            return cached_content
+
+        try:
+            self.escalate(*self.converter_document.analyze_pages(pdf_path))
+        except Exception:
+            self.converter_gpt.cleanup_conversion()
+            raise
+        return self.finish_conversion(document_key, self.converter_gpt.convert_pdf(pdf_path))
+
+    async def convert_pdf_async(self, pdf_path: str):
+        """convert_pdf() on the async engine"""
+        document_key, cached_content = await asyncio.to_thread(self.cached_document, pdf_path)
+        if cached_content is not None:
+            return cached_content
+
+        try:
+            self.escalate(*await self.converter_document.analyze_pages_async(pdf_path))
+        except BaseException:
+            self.converter_gpt.cleanup_conversion()
+            raise
+        content = await self.converter_gpt.convert_pdf_async(pdf_path)
+        return await asyncio.to_thread(self.finish_conversion, document_key, content)
@@ -0,0 +1,351 @@
+import asyncio
+import math
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from config import *
+
+WINDOW_SECONDS = 60
+
+def estimate_text_tokens(text: str):
+    """Rough token count for prompt text (about four characters per token)"""
+    return math.ceil(len(text) / 4)
+
+def estimate_image_tokens(width: int, height: int):
+    """Token cost of a high-detail image: fit within 2048x2048, shortest side to 768, then 170 per 512px tile plus 85"""
+    if not width or not height:
+        return 1105  # A typical letter-size page
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def usage_tokens(completion):
+    """Total tokens reported by a completion, or None when the response has no usage"""
+    usage = getattr(completion, "usage", None)
+    return getattr(usage, "total_tokens", None) if usage is not None else None
+
+def usage_breakdown(completion):
+    """(prompt, cached prompt, completion) tokens of a completion; zeros when the response has no usage"""
+    usage = getattr(completion, "usage", None)
+    if usage is None:
+        return 0, 0, 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    return usage.prompt_tokens or 0, cached_tokens, usage.completion_tokens or 0
+
+def is_rate_limited(error):
+    """True for 429 responses from either SDK"""
+    return getattr(error, "status_code", None) == 429 or getattr(getattr(error, "response", None), "status_code", None) == 429
+
+def parse_duration(value: str):
+    """Seconds in a header value such as "2", "1.5", "20ms", "6m0s" or an HTTP date"""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if parts:
+        scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(amount) * scale[unit] for amount, unit in parts)
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def retry_after_seconds(error):
+    """How long the service asked us to wait, from Retry-After or x-ratelimit-reset-* headers"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        return parse_duration(headers["retry-after-ms"] + "ms")
+    for header in ("retry-after", "x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        if headers.get(header):
+            seconds = parse_duration(headers[header])
+            if seconds is not None:
+                return seconds
+    return None
+
+class RateLimiter:
+    """Sliding-window token and request budget shared by every job that calls one deployment.
+
+    Waiting callers are admitted round-robin by job, so one large document cannot starve the
+    others. With RATE_LIMIT_DB_PATH set, usage is recorded in SQLite so the budget also holds
+    across worker processes.
+    """
+    def __init__(self, name: str, tokens_per_minute: int, requests_per_minute: int, db_path: str = RATE_LIMIT_DB_PATH):
+        self.name = name
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.db_path = db_path
+
+        self.condition = threading.Condition()
+        self.events = deque()  # [timestamp, tokens] admitted in the current window
+        self.tokens_in_window = 0
+        self.waiting = {}  # job_id -> number of waiting callers
+        self.turns = deque()  # Round-robin order of jobs with waiting callers
+
+        if db_path:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS rate_usage (limiter TEXT NOT NULL, ts REAL NOT NULL, tokens INTEGER NOT NULL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS rate_usage_limiter_ts ON rate_usage (limiter, ts)")
+
+    @property
+    def enabled(self):
+        return self.tokens_per_minute > 0 or self.requests_per_minute > 0
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def acquire(self, tokens: int, job_id: str = ""):
+        """Block until the request fits in the budget and it is this job's turn; returns a ticket for settle()"""
+        if not self.enabled:
+            return None
+
+        with self.condition:
+            self._join(job_id)
+            try:
+                while True:
+                    if self.turns[0] == job_id:
+                        ticket = self._try_admit(tokens)
+                        if ticket is not None:
+                            return ticket
+                    # Budget frees up as the window slides; other processes cannot notify us, so poll
+                    self.condition.wait(timeout=0.25)
+            finally:
+                self._leave(job_id)
+
+    async def acquire_async(self, tokens: int, job_id: str = ""):
+        """acquire() for the async engine: waits on the event loop instead of blocking a thread"""
+        if not self.enabled:
+            return None
+
+        with self.condition:
+            self._join(job_id)
+        try:
+            while True:
+                if self.db_path:
+                    # The shared window is a SQLite transaction that can wait on other processes; keep it off the loop
+                    ticket = await asyncio.to_thread(self._try_admit_turn, tokens, job_id)
+                else:
+                    ticket = self._try_admit_turn(tokens, job_id)
+                if ticket is not None:
+                    return ticket
+                await asyncio.sleep(0.25)
+        finally:
+            with self.condition:
+                self._leave(job_id)
+
+    def _join(self, job_id: str):
+        """Queue a caller for its job's turn (caller holds the condition)"""
+        if job_id not in self.waiting:
+            self.waiting[job_id] = 0
+            self.turns.append(job_id)
+        self.waiting[job_id] += 1
+
+    def _leave(self, job_id: str):
+        """Remove an admitted or abandoned caller (caller holds the condition)"""
+        self.waiting[job_id] -= 1
+        self.turns.remove(job_id)
+        if self.waiting[job_id] > 0:
+            self.turns.append(job_id)  # Back of the line for this job's next caller
+        else:
+            del self.waiting[job_id]
+        self.condition.notify_all()
+
+    def _try_admit_turn(self, tokens: int, job_id: str):
+        """_try_admit() if it is this job's turn"""
+        with self.condition:
+            if self.turns[0] == job_id:
+                return self._try_admit(tokens)
+            return None
+
+    def _try_admit(self, tokens: int):
+        """Record the request if it fits in the current window (caller holds the condition)"""
+        now = time.time()
+        if self.db_path:
+            return self._try_admit_shared(tokens, now)
+
+        while self.events and self.events[0][0] <= now - WINDOW_SECONDS:
+            self.tokens_in_window -= self.events.popleft()[1]
+        if not self._fits(len(self.events), self.tokens_in_window, tokens):
+            return None
+
+        ticket = [now, tokens]
+        self.events.append(ticket)
+        self.tokens_in_window += tokens
+        return ticket
+
+    def _try_admit_shared(self, tokens: int, now: float):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM rate_usage WHERE limiter = ? AND ts <= ?", (self.name, now - WINDOW_SECONDS))
+            count, used = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM rate_usage WHERE limiter = ?", (self.name,)
+            ).fetchone()
+            if not self._fits(count, used, tokens):
+                conn.execute("COMMIT")
+                return None
+            cursor = conn.execute("INSERT INTO rate_usage (limiter, ts, tokens) VALUES (?, ?, ?)", (self.name, now, tokens))
+            conn.execute("COMMIT")
+            return cursor.lastrowid
+
+    def _fits(self, requests: int, used_tokens: int, tokens: int):
+        if self.requests_per_minute > 0 and requests >= self.requests_per_minute:
+            return False
+        # A single request larger than the whole budget is still let through on an empty window
+        if self.tokens_per_minute > 0 and used_tokens + tokens > self.tokens_per_minute and used_tokens > 0:
+            return False
+        return True
+
+    def settle(self, ticket, actual_tokens: int):
+        """Replace the estimate of an admitted request with the tokens it actually used"""
+        if ticket is None or actual_tokens is None:
+            return
+
+        if self.db_path:
+            with self._connect() as conn:
+                conn.execute("UPDATE rate_usage SET tokens = ? WHERE rowid = ?", (actual_tokens, ticket))
+            return
+
+        with self.condition:
+            # Only adjust while the request still counts against the window
+            if self.events and ticket[0] > time.time() - WINDOW_SECONDS:
+                self.tokens_in_window += actual_tokens - ticket[1]
+                ticket[1] = actual_tokens
+            self.condition.notify_all()
+
+    async def settle_async(self, ticket, actual_tokens: int):
+        """settle() for the async engine; the SQLite write of a shared limiter runs in a thread"""
+        if self.db_path:
+            await asyncio.to_thread(self.settle, ticket, actual_tokens)
+        else:
+            self.settle(ticket, actual_tokens)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "tokens_per_minute": self.tokens_per_minute,
+                "requests_per_minute": self.requests_per_minute,
+                "requests_in_window": len(self.events),
+                "tokens_in_window": self.tokens_in_window,
+                "waiting_jobs": len(self.turns),
+                "shared": bool(self.db_path)
+            }
+
+class AdaptiveConcurrency:
+    """AIMD limit on in-flight requests to one deployment, shared by every job in the process.
+
+    The limit grows by one per round trip of successful calls and is cut by AIMD_DECREASE_FACTOR
+    on a 429 or a latency spike. A Retry-After from the service pauses new requests until it passes.
+    """
+    def __init__(self, name: str, initial: int, minimum: int, maximum: int):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.latency_ewma = None
+        self.pace_ewma = None  # Seconds per estimated token
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+        self.async_waiters = []  # (loop, future) of async engine callers waiting for a slot
+
+    def _try_acquire(self):
+        """Take a slot if one is free; otherwise return how long a pause has left, 0 if none (caller holds the condition)"""
+        wait_time = self.paused_until - time.time()
+        if wait_time <= 0 and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return None
+        return max(0.0, wait_time)
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait_time = self._try_acquire()
+                if wait_time is None:
+                    return
+                self.condition.wait(timeout=wait_time or None)
+
+    async def acquire_async(self):
+        """acquire() for the async engine; threads and event loops share the same slots"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                wait_time = self._try_acquire()
+                if wait_time is None:
+                    return
+                waiter = loop.create_future()
+                self.async_waiters.append((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, timeout=wait_time or None)
+            except asyncio.TimeoutError:
+                pass
+
+    def _notify(self):
+        """Wake every waiting thread and coroutine (caller holds the condition)"""
+        self.condition.notify_all()
+        for loop, waiter in self.async_waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(lambda waiter=waiter: waiter.done() or waiter.set_result(None))
+        self.async_waiters.clear()
+
+    def release(self, latency: float = None, tokens: int = 1, throttled: bool = False, retry_after: float = None,
+                near_quota: bool = False):
+        """Return a slot and feed back how the call went; tokens is the call's estimated size"""
+        with self.condition:
+            self.in_flight -= 1
+            now = time.time()
+
+            if throttled:
+                self._decrease(now)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            elif latency is not None:
+                # Spikes are judged per estimated token, so a batch of pages or a short text-only call
+                # is not mistaken for congestion next to single-page calls
+                pace = latency / max(1, tokens)
+                spike = self.pace_ewma is not None and pace > self.pace_ewma * AIMD_LATENCY_SPIKE_FACTOR
+                if spike:
+                    self._decrease(now)
+                elif not near_quota:
+                    # Additive increase: about +1 once every slot has completed a call
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.pace_ewma = pace if self.pace_ewma is None else 0.8 * self.pace_ewma + 0.2 * pace
+                self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+
+            self._notify()
+
+    def _decrease(self, now: float):
+        # Calls in flight during one congestion event fail together; cut the limit once for all of them
+        cooldown = max(1.0, self.latency_ewma or 0.0)
+        if now - self.last_decrease < cooldown:
+            return
+        self.limit = max(self.minimum, self.limit * AIMD_DECREASE_FACTOR)
+        self.last_decrease = now
+        print(f">>>> {self.name} concurrency reduced to {int(self.limit)}")
+
+    def stats(self):
+        with self.condition:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "latency_ewma": self.latency_ewma,
+                "paused_for": max(0.0, self.paused_until - time.time())
+            }
@@ -0,0 +1,225 @@
+import asyncio
+import gzip
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlsplit
+from config import *
+from metrics import metrics
+from rate_limit import parse_duration
+
+try:
+    import httpx
+except ImportError:  # Newer openai releases ship their HTTP stack as httpx2
+    import httpx2 as httpx
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    url TEXT NOT NULL,
+    body BLOB NOT NULL,
+    content_encoding TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    lease_expires_at REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS webhook_outbox_state_next ON webhook_outbox (state, next_attempt_at);
+"""
+
+class DeliveryState:
+    PENDING = 'pending'
+    SENDING = 'sending'
+    FAILED = 'failed'
+
+class WebhookOutbox:
+    """Persistent queue of webhook deliveries, so a result survives restarts and unreachable receivers"""
+    def __init__(self, db_path: str = JOB_DB_PATH):
+        self.db_path = db_path
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, job_id: str, url: str, payload: dict):
+        """Store a delivery, gzip-compressing large bodies once here rather than on every attempt"""
+        body = json.dumps(payload).encode("utf-8")
+        content_encoding = ""
+        if WEBHOOK_GZIP and len(body) >= WEBHOOK_GZIP_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=6)
+            content_encoding = "gzip"
+
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT INTO webhook_outbox (job_id, url, body, content_encoding, state, next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, url, body, content_encoding, DeliveryState.PENDING, now, now, now)
+            )
+
+    def claim(self, limit: int):
+        """Atomically take up to limit due deliveries, or ones whose dispatcher stopped before finishing them"""
+        if limit <= 0:
+            return []
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                rows = conn.execute(
+                    "SELECT * FROM webhook_outbox WHERE (state = ? AND next_attempt_at <= ?) OR (state = ? AND lease_expires_at < ?) ORDER BY next_attempt_at LIMIT ?",
+                    (DeliveryState.PENDING, now, DeliveryState.SENDING, now, limit)
+                ).fetchall()
+                conn.executemany(
+                    "UPDATE webhook_outbox SET state = ?, lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                    [(DeliveryState.SENDING, now + WEBHOOK_LEASE_SECONDS, now, row["id"]) for row in rows]
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return [dict(row) for row in rows]
+
+    def delivered(self, delivery_id: int):
+        """Drop a delivered result"""
+        with self.connect() as conn:
+            conn.execute("DELETE FROM webhook_outbox WHERE id = ?", (delivery_id,))
+
+    def retry(self, delivery_id: int, attempts: int, delay: float, error: str):
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE webhook_outbox SET state = ?, attempts = ?, next_attempt_at = ?, lease_expires_at = NULL, last_error = ?, updated_at = ? WHERE id = ?",
+                (DeliveryState.PENDING, attempts, time.time() + delay, error, time.time(), delivery_id)
+            )
+
+    def fail(self, delivery_id: int, attempts: int, error: str):
+        """Give up on a delivery; it is kept until purged so it can be inspected"""
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE webhook_outbox SET state = ?, attempts = ?, lease_expires_at = NULL, last_error = ?, updated_at = ? WHERE id = ?",
+                (DeliveryState.FAILED, attempts, error, time.time(), delivery_id)
+            )
+
+    def purge_failed(self, older_than: float):
+        with self.connect() as conn:
+            conn.execute(
+                "DELETE FROM webhook_outbox WHERE state = ? AND updated_at < ?", (DeliveryState.FAILED, time.time() - older_than)
+            )
+
+    def stats(self):
+        with self.connect() as conn:
+            rows = conn.execute("SELECT state, COUNT(*) AS count FROM webhook_outbox GROUP BY state").fetchall()
+        return {DeliveryState.PENDING: 0, DeliveryState.SENDING: 0, DeliveryState.FAILED: 0, **{row["state"]: row["count"] for row in rows}}
+
+class WebhookDispatcher:
+    """Posts outbox deliveries on a pooled async client, a few at a time per receiving host, retrying with exponential backoff"""
+    def __init__(self, outbox: WebhookOutbox, job_queue=None):
+        self.outbox = outbox
+        self.job_queue = job_queue  # Finished jobs are dropped from it once their result is delivered
+        self.client = None
+        self.host_slots = {}  # host -> asyncio.Semaphore
+
+    def create_client(self):
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(WEBHOOK_TIMEOUT_SECONDS),
+            limits=httpx.Limits(
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                max_keepalive_connections=WEBHOOK_MAX_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_SECONDS
+            )
+        )
+
+    def retry_delay(self, attempts: int, retry_after: float = None):
+        """Exponential backoff after the given number of failed attempts, or the receiver's Retry-After when longer"""
+        delay = min(WEBHOOK_RETRY_MAX_DELAY, WEBHOOK_RETRY_DELAY * (2 ** (attempts - 1)))
+        return max(delay, retry_after or 0.0)
+
+    async def deliver(self, delivery: dict):
+        """Make one attempt at a delivery and record its outcome in the outbox"""
+        host = urlsplit(delivery["url"]).netloc
+        slots = self.host_slots.setdefault(host, asyncio.Semaphore(WEBHOOK_MAX_PER_HOST))
+        headers = {"Content-Type": "application/json"}
+        if delivery["content_encoding"]:
+            headers["Content-Encoding"] = delivery["content_encoding"]
+
+        attempts = delivery["attempts"] + 1
+        retry_after = None
+        try:
+            async with slots:
+                response = await self.client.post(delivery["url"], content=delivery["body"], headers=headers)
+            if response.is_success:
+                await asyncio.to_thread(self.outbox.delivered, delivery["id"])
+                if self.job_queue is not None:
+                    # Nobody polls a hook job; until now its rows served /status/{job_id}/stream
+                    await asyncio.to_thread(self.job_queue.delete_finished, delivery["job_id"])
+                await self.record("delivered")
+                print(f"Delivered result of job {delivery['job_id']} to {delivery['url']}")
+                return
+
+            error = f"HTTP {response.status_code}"
+            if response.headers.get("retry-after"):
+                retry_after = parse_duration(response.headers["retry-after"])
+            # Other client errors will not go away by retrying
+            retryable = response.status_code in (408, 425, 429) or response.status_code >= 500
+        except httpx.HTTPError as e:
+            error = f"{type(e).__name__}: {str(e)}"
+            retryable = True
+        except Exception as e:
+            # e.g. a malformed hook_url
+            error = f"{type(e).__name__}: {str(e)}"
+            retryable = False
+
+        if retryable and attempts < WEBHOOK_MAX_ATTEMPTS:
+            delay = self.retry_delay(attempts, retry_after)
+            print(f"Failed to deliver result of job {delivery['job_id']} to {delivery['url']}: {error}. Retrying in {delay:.0f} seconds...")
+            await self.record("retry")
+            await asyncio.to_thread(self.outbox.retry, delivery["id"], attempts, delay, error)
+        else:
+            print(f"Giving up delivering result of job {delivery['job_id']} to {delivery['url']} after {attempts} attempts: {error}")
+            await self.record("failed")
+            await asyncio.to_thread(self.outbox.fail, delivery["id"], attempts, error)
+
+    async def record(self, outcome: str):
+        metrics.inc("pdf2md_webhook_deliveries_total", outcome=outcome)
+        # worker.py runs its dispatcher outside the API process
+        await asyncio.to_thread(metrics.flush)
+
+    async def run(self, stop_event):
+        """Deliver due results until stop_event (a threading or multiprocessing Event) is set"""
+        self.client = self.create_client()
+        tasks = set()
+        last_purge = 0.0
+        try:
+            while not stop_event.is_set():
+                try:
+                    for delivery in await asyncio.to_thread(self.outbox.claim, WEBHOOK_MAX_CONNECTIONS - len(tasks)):
+                        task = asyncio.create_task(self.deliver(delivery))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+
+                    if time.time() - last_purge > 60:
+                        await asyncio.to_thread(self.outbox.purge_failed, JOB_FAILED_RETENTION_HOURS * 3600)
+                        last_purge = time.time()
+                except Exception as e:
+                    print(f"Webhook dispatcher error: {str(e)}")
+                await asyncio.sleep(WEBHOOK_POLL_INTERVAL)
+
+            # Unfinished deliveries are claimed again once their lease expires
+            if tasks:
+                await asyncio.wait(tasks, timeout=WEBHOOK_TIMEOUT_SECONDS)
+        finally:
+            await self.client.aclose()
@@ -0,0 +1,26 @@
+"""Run conversion workers without the API, e.g. when uvicorn is started with JOB_WORKERS=0.
+
+Usage: python worker.py [worker_count]
+"""
+import asyncio
+import signal
+import sys
+import threading
+
+from app import job_queue, process_job, webhook_outbox
+from config import JOB_WORKERS
+from job_queue import start_workers, stop_workers
+from webhooks import WebhookDispatcher
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else max(1, JOB_WORKERS)
+    processes, stop_event = start_workers(process_job, count)
+    print(f"Started {count} conversion workers")
+
+    # Deliver webhooks until SIGINT/SIGTERM, then let in-flight jobs be reclaimed after their lease expires
+    shutdown = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: shutdown.set())
+    signal.signal(signal.SIGINT, lambda *_: shutdown.set())
+    asyncio.run(WebhookDispatcher(webhook_outbox, job_queue).run(shutdown))
+
+    stop_workers(processes, stop_event)